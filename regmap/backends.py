@@ -1,4 +1,8 @@
-from .types import Backend
+from .types import Backend, Register, RegWO
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+import time
+import threading
 import unittest
 
 class IntBackend(Backend):
@@ -13,25 +17,68 @@ class IntBackend(Backend):
 		mask = (1 << length) - 1
 		return (self.value >> start) & mask
 
+class RangeMap(object):
+	"""Map disjoint bit ranges [start, start + length) to values."""
+	def __init__(self):
+		self.starts = []
+		self.ends = []
+		self.values = []
+	def add(self, start, length, value):
+		k = bisect_right(self.starts, start)
+		if (k and self.ends[k - 1] > start) or (k < len(self.starts) and self.starts[k] < start + length):
+			raise ValueError("range %d+%d overlaps an existing one" % (start, length))
+		self.starts.insert(k, start)
+		self.ends.insert(k, start + length)
+		self.values.insert(k, value)
+	def lookup(self, start, length):
+		"""Return the values of all ranges overlapping [start, start + length)"""
+		if not self.starts:
+			return []
+		return self.values[bisect_right(self.ends, start):bisect_left(self.starts, start + length)]
+	def overlaps(self, start, length):
+		"""Return (start, end, value) for all ranges overlapping [start, start + length)"""
+		lo = bisect_right(self.ends, start)
+		hi = bisect_left(self.starts, start + length)
+		return zip(self.starts[lo:hi], self.ends[lo:hi], self.values[lo:hi])
+
+
 class GranularBackend(Backend):
 	"""A backend which has a (lower) limit on granularity.
 	
 	For example, one cannot write less than 32 bits at a time; as such,
 	writing a single bit may mean a read-modify-write cycle,  or it may
 	be forbidden.
+
+	The granularity can be overridden for address windows with
+	set_granularity().  In @coalesce mode, writes to the same or
+	neighbouring granules are queued and issued as one wider access,
+	when a non-adjacent access, a read of bits not queued, an update
+	boundary or flush() comes along.
 	"""
 	granularity = 32 # bits
 
-	def __init__(self, backend):
+	def __init__(self, backend, coalesce=False):
 		self.backend = backend
-	
+		self.coalesce = coalesce
+		self.windows = RangeMap()
+		# queued writes: [start, end, mask, value], relative to start
+		self.pending = None
+
+	def set_granularity(self, start, length, granularity):
+		"""Use @granularity for accesses within [start, start + length)"""
+		self.windows.add(start, length, granularity)
+	def granularity_at(self, start, length):
+		found = self.windows.lookup(start, length)
+		return max(found) if found else self.granularity
+
 	def compute_region(self, start, length):
 		"""Return [start, end) boundaries required for accessing the underlying backend"""
-		real_start = start - (start % self.granularity)
+		granularity = self.granularity_at(start, length)
+		real_start = start - (start % granularity)
 		real_end = start + length
-		frag = real_end % self.granularity
+		frag = real_end % granularity
 		if frag:
-			real_end += self.granularity - frag
+			real_end += granularity - frag
 		return (real_start, real_end)
 	def compute_mask(self, start, length):
 		rstart, rend = self.compute_region(start, length)
@@ -40,6 +87,8 @@ class GranularBackend(Backend):
 		delta = start - rstart
 		return rstart, rlen, delta, mask
 	def set_bits(self, start, length, value):
+		if self.coalesce:
+			return self.queue(start, length, (1 << length) - 1, value)
 		rstart, rlen, delta, mask = self.compute_mask(start, length)
 		if rstart < start or rlen > length:
 			data = self.backend.get_bits(rstart, rlen)
@@ -48,13 +97,64 @@ class GranularBackend(Backend):
 		data = data & ~(mask << delta) | (value << delta)
 		self.backend.set_bits(rstart, rlen, data)
 	def get_bits(self, start, length):
+		if self.pending:
+			pstart, pend, pmask, pvalue = self.pending
+			mask = (1 << length) - 1
+			delta = start - pstart
+			if delta >= 0 and start + length <= pend and (pmask >> delta) & mask == mask:
+				return (pvalue >> delta) & mask
+			self.flush()
 		rstart, rlen, delta, mask = self.compute_mask(start, length)
 		data = self.backend.get_bits(rstart, rlen)
 		return (data >> delta) & mask
+	def update_bits(self, start, length, mask, value):
+		if self.coalesce:
+			return self.queue(start, length, mask, value)
+		rstart, rlen, delta, _ = self.compute_mask(start, length)
+		mask <<= delta
+		value <<= delta
+		if mask != (1 << rlen) - 1:
+			value = self.backend.get_bits(rstart, rlen) & ~mask | value & mask
+		self.backend.set_bits(rstart, rlen, value)
+
+	def queue(self, start, length, mask, value):
+		"""Queue a write of the @mask bits of @value, merging it with pending ones if possible"""
+		rstart, rend = self.compute_region(start, length)
+		mask <<= start - rstart
+		value = (value << (start - rstart)) & mask
+		if self.pending:
+			pstart, pend, pmask, pvalue = self.pending
+			if rstart > pend or rend < pstart:
+				self.flush()
+			else:
+				lo = min(pstart, rstart)
+				pmask <<= pstart - lo
+				pvalue <<= pstart - lo
+				mask <<= rstart - lo
+				value <<= rstart - lo
+				mask, value = pmask | mask, pvalue & ~mask | value
+				rstart, rend = lo, max(pend, rend)
+		self.pending = [rstart, rend, mask, value]
+	def flush(self):
+		"""Issue the queued writes"""
+		if not self.pending:
+			return
+		start, end, mask, value = self.pending
+		self.pending = None
+		length = end - start
+		if mask != (1 << length) - 1:
+			value = self.backend.get_bits(start, length) & ~mask | value
+		self.backend.set_bits(start, length, value)
+
+	def buffer(self):
+		self.flush() # the memory must show the queued writes
+		return self.backend.buffer()
 	def begin_update(self, start, length, mode):
+		self.flush()
 		rstart, rlen, delta, mask = self.compute_mask(start, length)
 		return self.backend.begin_update(rstart, rlen, mode)
 	def end_update(self, start, length, mode):
+		self.flush()
 		rstart, rlen, delta, mask = self.compute_mask(start, length)
 		return self.backend.end_update(rstart, rlen, mode)
 
@@ -68,59 +168,103 @@ class WindowBackend(Backend):
 		return self.backend.set_bits(self.offset + start, length, value)
 	def get_bits(self, start, length):
 		return self.backend.get_bits(self.offset + start, length)
+	def shadow_bits(self, start, length):
+		return self.backend.shadow_bits(self.offset + start, length)
 	def begin_update(self, start, length, mode):
-		return self.backend.begin_update(self.offset + start, length)
+		return self.backend.begin_update(self.offset + start, length, mode)
 	def end_update(self, start, length, mode):
-		return self.backend.end_update(self.offset + start, length)
+		return self.backend.end_update(self.offset + start, length, mode)
 
 class CachingBackend(Backend):
-	"""A caching wrapper around another backend."""
+	"""A caching wrapper around another backend.
+
+	Within a begin_update() / end_update() pair, accesses are served from
+	a cache of the region, which is written back at the end.  Nested
+	updates are served from (and merged back into) the enclosing one;
+	only the outermost end_update() writes to the real backend."""
 
 	class CachedAccess(object):
-		def __init__(self, backend, start, length, mode):
+		"""The cached bits [start, start + length) of @source.
+
+		@source is the real backend, or the enclosing CachedAccess."""
+		def __init__(self, source, start, length, mode):
+			self.source = source
+			self.update = (start, length, mode)
 			self.start = start
 			self.length = length
 			self.mode = mode
-			self.real_backend = backend
-			self.backend = WindowBackend(IntBackend(), -start)
+			self.value = 0
+			self.written = 0
 			if self.mode != Backend.MODE_WRITE:
-				self.backend.set_bits(start, length, backend.get_bits(start, length))
-			self.written = WindowBackend(IntBackend(), -start)
-		def set_bits(self, start, length, value):
+				self.value = source.get_bits(start, length)
+		def extend(self, start, length):
+			"""Grow the cached region, if needed, to cover [start, start + length)"""
+			end = max(start + length, self.start + self.length)
+			if start < self.start:
+				delta = self.start - start
+				self.value <<= delta
+				self.written <<= delta
+				if self.mode != Backend.MODE_WRITE:
+					self.value |= self.source.get_bits(start, delta)
+				self.start = start
+				self.length += delta
+			old_end = self.start + self.length
+			if end > old_end:
+				if self.mode != Backend.MODE_WRITE:
+					self.value |= self.source.get_bits(old_end, end - old_end) << (old_end - self.start)
+				self.length = end - self.start
+		def merge(self, start, length, mask, value):
+			"""Set the bits selected by @mask (relative to @start) to @value"""
 			if self.mode == Backend.MODE_READ:
 				raise ValueError("read-only cache access tried to set bits")
-			self.written.set_bits(start, length, (1 << length) - 1)
-			return self.backend.set_bits(start, length, value)
+			self.extend(start, length)
+			delta = start - self.start
+			mask <<= delta
+			self.value = self.value & ~mask | (value << delta) & mask
+			self.written |= mask
+		def set_bits(self, start, length, value):
+			return self.merge(start, length, (1 << length) - 1, value)
 		def get_bits(self, start, length):
 			if self.mode == Backend.MODE_WRITE:
 				raise ValueError("write-only cache access tried to get bits")
-			return self.backend.get_bits(start, length)
+			self.extend(start, length)
+			return (self.value >> (start - self.start)) & ((1 << length) - 1)
 
 	def __init__(self, backend):
 		self.backend = backend
-		self.cache = [backend]
+		self.local = threading.local()
+
+	@property
+	def cache(self):
+		"""The stack of cached accesses of the current thread"""
+		try:
+			return self.local.cache
+		except AttributeError:
+			self.local.cache = [self.backend]
+			return self.local.cache
 
 	def begin_update(self, start, length, mode):
-		self.cache.append(self.CachedAccess(self.backend, start, length, mode))
+		self.cache.append(self.CachedAccess(self.cache[-1], start, length, mode))
 	def end_update(self, start, length, mode):
-		assert len(self.cache) > 1
-		acc = self.cache.pop()
+		cache = self.cache
+		assert len(cache) > 1
+		acc = cache.pop()
 		if mode == Backend.MODE_DISCARD:
 			return
 		# 'with' statements must be properly nested, if at all:
-		assert acc.start == start
-		assert acc.length == length
-		assert acc.mode == mode
-		mask = acc.written.get_bits(start, length)
-		full = (1 << length) - 1
+		assert acc.update == (start, length, mode)
+		full = (1 << acc.length) - 1
 		if mode == Backend.MODE_WRITE:
-			if mask != full:
-				raise ValueError("write-only cached access did not set all bits (0x%x missing)" % (full ^ mask))
-		if mask:
-			assert mode != Backend.MODE_READ # should be caught earlier
-			self.backend.set_bits(start, length, acc.backend.get_bits(start, length))
-		# TODO: may require reloading the next top of cache, or merging
-		assert len(self.cache) == 1, "nested cached 'with' statements not yet supported"
+			if acc.written != full:
+				raise ValueError("write-only cached access did not set all bits (0x%x missing)" % (full ^ acc.written))
+		if not acc.written:
+			return
+		assert mode != Backend.MODE_READ # should be caught earlier
+		cache = self.cache
+		if len(cache) > 1:
+			cache[-1].merge(acc.start, acc.length, acc.written, acc.value)
+		else:
+			self.backend.set_bits(acc.start, acc.length, acc.value)
 
 	def set_bits(self, start, length, value):
 		return self.cache[-1].set_bits(start, length, value)
@@ -128,6 +272,423 @@ class CachingBackend(Backend):
 		return self.cache[-1].get_bits(start, length)
 
 
+class WriteBackCache(Backend):
+	"""A long-lived write-back cache around another backend.
+
+	Whole granules are kept resident.  Writes only update the cache and
+	are written back (consecutive dirty granules as one access) by flush(),
+	or when more than @max_granules are cached and the least recently used
+	ones get evicted.  Volatile ranges bypass the cache.
+
+	Unlike CachingBackend, begin_update() / end_update() do nothing here.
+	"""
+	granularity = 32 # bits
+
+	def __init__(self, backend, max_granules=1024, granularity=None):
+		self.backend = backend
+		self.max_granules = max_granules
+		if granularity is not None:
+			self.granularity = granularity
+		self.full = (1 << self.granularity) - 1
+		# granule index -> [value, valid mask, dirty mask], in LRU order
+		self.granules = OrderedDict()
+		self.volatile = RangeMap()
+
+	def set_volatile(self, start, length):
+		"""Never cache accesses to [start, start + length)"""
+		self.volatile.add(start, length, True)
+	def mark_volatile(self, reg):
+		"""Never cache accesses to the register instance @reg"""
+		self.set_volatile(reg._bit_offset, reg._bit_length)
+	def apply_policies(self, reg):
+		"""Bypass the cache for registers in @reg defined with CACHE_VOLATILE"""
+		for start, length, policy in reg._cache_policies():
+			if policy == Register.CACHE_VOLATILE:
+				self.set_volatile(start, length)
+
+	def _span(self, start, length):
+		g = self.granularity
+		return start // g, (start + length + g - 1) // g
+	def _entry(self, k):
+		entry = self.granules.pop(k, None)
+		if entry is None:
+			entry = [0, 0, 0]
+		self.granules[k] = entry
+		return entry
+	def _mask(self, k, start, length):
+		"""Return the mask of bits of granule @k within [start, start + length)"""
+		base = k * self.granularity
+		lo = max(start, base)
+		hi = min(start + length, base + self.granularity)
+		return ((1 << (hi - lo)) - 1) << (lo - base)
+	def _fetch(self, start, length):
+		"""Make the bits [start, start + length) resident, reading runs of granules at once"""
+		g = self.granularity
+		first, last = self._span(start, length)
+		run = None
+		for k in xrange(first, last + 1):
+			if k < last:
+				mask = self._mask(k, start, length)
+				if self._entry(k)[1] & mask != mask:
+					if run is None:
+						run = k
+					continue
+			if run is None:
+				continue
+			data = self.backend.get_bits(run * g, (k - run) * g)
+			for j in xrange(run, k):
+				entry = self.granules[j]
+				fresh = (data >> ((j - run) * g)) & self.full
+				entry[0] = fresh & ~entry[2] | entry[0] & entry[2]
+				entry[1] = self.full
+			run = None
+	def _evict(self):
+		while len(self.granules) > self.max_granules:
+			k, entry = self.granules.popitem(last=False)
+			if entry[2]:
+				self._writeback([(k, entry)])
+
+	def _patch(self, start, length, value):
+		"""Update the cached granules over [start, start + length) with @value, read or written directly"""
+		g = self.granularity
+		first, last = self._span(start, length)
+		for k in xrange(first, last):
+			entry = self.granules.get(k)
+			if entry is None:
+				continue
+			mask = self._mask(k, start, length)
+			delta = k * g - start
+			entry[0] = entry[0] & ~mask | (value >> delta if delta >= 0 else value << -delta) & mask
+	def _volatile_mask(self, k):
+		"""Return the mask of the volatile bits of granule @k"""
+		g = self.granularity
+		mask = 0
+		for start, end, value in self.volatile.overlaps(k * g, g):
+			mask |= self._mask(k, start, end - start)
+		return mask
+
+	def get_bits(self, start, length):
+		if self.volatile.lookup(start, length):
+			self.flush(start, length)
+			value = self.backend.get_bits(start, length)
+			self._patch(start, length, value)
+			return value
+		g = self.granularity
+		first, last = self._span(start, length)
+		self._fetch(start, length)
+		value = 0
+		for k in xrange(last - 1, first - 1, -1):
+			value = (value << g) | self.granules[k][0]
+		self._evict()
+		return (value >> (start - first * g)) & ((1 << length) - 1)
+	def set_bits(self, start, length, value):
+		value &= (1 << length) - 1
+		if self.volatile.lookup(start, length):
+			self.flush(start, length)
+			self._patch(start, length, value)
+			return self.backend.set_bits(start, length, value)
+		g = self.granularity
+		first, last = self._span(start, length)
+		for k in xrange(first, last):
+			mask = self._mask(k, start, length)
+			delta = k * g - start
+			bits = (value >> delta if delta >= 0 else value << -delta) & mask
+			entry = self._entry(k)
+			entry[0] = entry[0] & ~mask | bits
+			entry[1] |= mask
+			entry[2] |= mask
+		self._evict()
+
+	def _writeback(self, entries):
+		"""Write back (index, entry) pairs of consecutive dirty granules.
+
+		Volatile bits are never written back; they are left to the backend's
+		update_bits()."""
+		g = self.granularity
+		first = entries[0][0]
+		value = mask = 0
+		for k, entry in reversed(entries):
+			volatile = self._volatile_mask(k)
+			if not volatile and entry[1] | entry[2] != self.full:
+				# partially written and never read: merge with the device
+				fresh = self.backend.get_bits(k * g, g)
+				entry[0] = fresh & ~entry[2] | entry[0] & entry[2]
+				entry[1] = self.full
+			value = (value << g) | entry[0]
+			mask = (mask << g) | (entry[1] | entry[2]) & ~volatile
+			entry[2] = 0
+		self.backend.update_bits(first * g, len(entries) * g, mask, value & mask)
+	def flush(self, start=None, length=None):
+		"""Write back dirty granules (all of them, or those covering the given range)"""
+		if start is None:
+			dirty = sorted(k for k, entry in self.granules.iteritems() if entry[2])
+		else:
+			first, last = self._span(start, length)
+			dirty = [k for k in xrange(first, last) if k in self.granules and self.granules[k][2]]
+		run = []
+		for k in dirty:
+			if run and run[-1][0] != k - 1:
+				self._writeback(run)
+				run = []
+			run.append((k, self.granules[k]))
+		if run:
+			self._writeback(run)
+	def invalidate(self):
+		"""Write back, then drop all cached granules"""
+		self.flush()
+		self.granules.clear()
+
+
+class ReadCacheBackend(Backend):
+	"""A write-through wrapper that caches reads according to register cache policies.
+
+	Policies (see Register) are set per range with set_policy(), or taken
+	from register definitions with apply_policies().  Reads of ranges with
+	no policy use @default; reads touching anything volatile always reach
+	the backend.  Writes invalidate the cached reads they overlap.
+	"""
+	def __init__(self, backend, default=Register.CACHE_VOLATILE, clock=time.time):
+		self.backend = backend
+		self.default = default
+		self.clock = clock
+		self.policies = RangeMap()
+		# (start, length) -> (value, expiry time)
+		self.cache = {}
+		# the keys of cache, sorted, and the longest of them
+		self.keys = []
+		self.widest = 0
+
+	def set_policy(self, start, length, policy):
+		self.policies.add(start, length, policy)
+	def apply_policies(self, reg):
+		"""Use the cache policies defined for the register instance @reg"""
+		for start, length, policy in reg._cache_policies():
+			self.set_policy(start, length, policy)
+
+	def lifetime(self, start, length):
+		"""Return how long a read of [start, start + length) stays valid, in seconds"""
+		pols = []
+		covered = 0
+		for begin, end, policy in self.policies.overlaps(start, length):
+			covered += min(end, start + length) - max(begin, start)
+			pols.append(policy)
+		if covered < length:
+			pols.append(self.default)
+		ttl = float('inf')
+		for policy in pols:
+			if policy == Register.CACHE_VOLATILE:
+				return 0
+			if policy != Register.CACHE_CONSTANT:
+				ttl = min(ttl, policy)
+		return ttl
+
+	def get_bits(self, start, length):
+		now = self.clock()
+		hit = self.cache.get((start, length))
+		if hit is not None and now < hit[1]:
+			return hit[0]
+		value = self.backend.get_bits(start, length)
+		ttl = self.lifetime(start, length)
+		if ttl > 0:
+			if hit is None:
+				insort(self.keys, (start, length))
+				self.widest = max(self.widest, length)
+			self.cache[(start, length)] = (value, now + ttl)
+		return value
+	def set_bits(self, start, length, value):
+		self.invalidate(start, length)
+		return self.backend.set_bits(start, length, value)
+	def invalidate(self, start=None, length=None):
+		"""Forget cached reads (all of them, or those overlapping a range)"""
+		if start is None:
+			self.cache.clear()
+			self.keys = []
+			self.widest = 0
+			return
+		# only reads starting less than widest bits before the range can overlap it
+		lo = bisect_left(self.keys, (start - self.widest + 1,))
+		hi = bisect_left(self.keys, (start + length,))
+		keep = []
+		for key in self.keys[lo:hi]:
+			if key[0] + key[1] > start:
+				del self.cache[key]
+			else:
+				keep.append(key)
+		self.keys[lo:hi] = keep
+	def begin_update(self, start, length, mode):
+		return self.backend.begin_update(start, length, mode)
+	def end_update(self, start, length, mode):
+		return self.backend.end_update(start, length, mode)
+
+
+class ShadowBackend(Backend):
+	"""A wrapper that remembers the values written to write-only bits.
+
+	Reads of write-only bits are served from the shadow copy (zero until
+	first written), so that read-modify-write cycles in the layers above
+	(e.g. GranularBackend) write back the last value written instead of
+	whatever the device returns.  RegWO._getall() also reports it.
+	"""
+	def __init__(self, backend):
+		self.backend = backend
+		self.write_only = RangeMap()
+		self.shadow = 0
+		self.known = 0
+
+	def add_write_only(self, start, length):
+		self.write_only.add(start, length, True)
+	def attach(self, reg):
+		"""Shadow all RegWO sub-registers of the register instance @reg"""
+		for path, offset, sub in reg._reg._walk_leaves(offset=reg._bit_offset):
+			if isinstance(sub, RegWO):
+				self.add_write_only(offset, sub._bit_length)
+		if isinstance(reg._reg, RegWO):
+			self.add_write_only(reg._bit_offset, reg._bit_length)
+
+	def _wo_mask(self, start, length):
+		"""Return the mask of write-only bits in [start, start + length), relative to @start"""
+		mask = 0
+		for begin, end, _ in self.write_only.overlaps(start, length):
+			begin = max(begin, start)
+			end = min(end, start + length)
+			mask |= ((1 << (end - begin)) - 1) << (begin - start)
+		return mask
+	def get_bits(self, start, length):
+		mask = self._wo_mask(start, length)
+		if mask == (1 << length) - 1:
+			return (self.shadow >> start) & mask # nothing to ask the device
+		value = self.backend.get_bits(start, length)
+		if mask:
+			value = value & ~mask | (self.shadow >> start) & mask
+		return value
+	def set_bits(self, start, length, value):
+		mask = self._wo_mask(start, length)
+		if mask:
+			self.shadow = self.shadow & ~(mask << start) | (value & mask) << start
+			self.known |= mask << start
+		return self.backend.set_bits(start, length, value)
+	def shadow_bits(self, start, length):
+		mask = (1 << length) - 1
+		if (self.known >> start) & mask != mask:
+			return None
+		return (self.shadow >> start) & mask
+	def begin_update(self, start, length, mode):
+		return self.backend.begin_update(start, length, mode)
+	def end_update(self, start, length, mode):
+		return self.backend.end_update(start, length, mode)
+
+
+class LockingBackend(Backend):
+	"""A wrapper making accesses to another backend thread-safe.
+
+	Each granule is guarded by one of @stripes (reentrant) locks, so that
+	unrelated registers can be accessed in parallel.  Single accesses hold
+	the locks of the granules they touch; begin_update() / end_update()
+	(and thus rmw_access / write_access) hold them for the whole update,
+	making it atomic.  Locks are always taken in ascending order; accesses
+	within an update should stay within its region.
+
+	A range is locked as the wrapped backend will access it: widened by its
+	compute_region(), if it has one (GranularBackend), and otherwise to the
+	widest granularity of any GranularBackend further down.
+
+	The wrapped backend must cope with concurrent accesses to different
+	granules, as memory (MmapBackend) does; IntBackend does not.
+	"""
+	granularity = 32 # bits
+
+	def __init__(self, backend, granularity=None, stripes=64):
+		self.backend = backend
+		if granularity is not None:
+			self.granularity = granularity
+		self.region = getattr(backend, 'compute_region', None)
+		if self.region is None:
+			self.granularity = max(self.granularity, self.widest_granule(backend))
+		self.locks = [threading.RLock() for k in xrange(stripes)]
+		self.local = threading.local()
+
+	@staticmethod
+	def widest_granule(backend):
+		"""Return the widest granularity of the GranularBackends in the stack @backend"""
+		widest = 0
+		while backend is not None:
+			if isinstance(backend, GranularBackend):
+				widest = max([widest, backend.granularity] + backend.windows.values)
+			backend = getattr(backend, 'backend', None)
+		return widest
+	def _locks(self, start, length):
+		if self.region is not None:
+			start, end = self.region(start, length)
+			length = end - start
+		g = self.granularity
+		n = len(self.locks)
+		first, last = start // g, (start + length + g - 1) // g
+		if last - first >= n:
+			return self.locks
+		return [self.locks[k] for k in sorted(set(k % n for k in xrange(first, last)))]
+	def acquire(self, start, length):
+		"""Lock the granules of [start, start + length); return the locks held"""
+		locks = self._locks(start, length)
+		for lock in locks:
+			lock.acquire()
+		return locks
+	@staticmethod
+	def release(locks):
+		for lock in reversed(locks):
+			lock.release()
+
+	def get_bits(self, start, length):
+		locks = self.acquire(start, length)
+		try:
+			return self.backend.get_bits(start, length)
+		finally:
+			self.release(locks)
+	def set_bits(self, start, length, value):
+		locks = self.acquire(start, length)
+		try:
+			return self.backend.set_bits(start, length, value)
+		finally:
+			self.release(locks)
+	def update_bits(self, start, length, mask, value):
+		locks = self.acquire(start, length)
+		try:
+			return self.backend.update_bits(start, length, mask, value)
+		finally:
+			self.release(locks)
+	def begin_update(self, start, length, mode):
+		locks = self.acquire(start, length)
+		try:
+			self.backend.begin_update(start, length, mode)
+		except:
+			self.release(locks)
+			raise
+		self.local.__dict__.setdefault('held', []).append(locks)
+	def end_update(self, start, length, mode):
+		try:
+			return self.backend.end_update(start, length, mode)
+		finally:
+			self.release(self.local.held.pop())
+
+
+class SwitchableBackend(Backend):
+	"""A base for wrappers that can be switched off with disable().
+
+	While disabled, the accessors are the wrapped backend's own bound
+	methods (set as instance attributes), so the wrapper costs nothing."""
+	ACCESSORS = ('get_bits', 'set_bits', 'update_bits', 'begin_update', 'end_update')
+	enabled = True
+
+	def enable(self):
+		for name in self.ACCESSORS:
+			self.__dict__.pop(name, None)
+		self.enabled = True
+	def disable(self):
+		"""Send accesses straight to the wrapped backend"""
+		for name in self.ACCESSORS:
+			setattr(self, name, getattr(self.backend, name))
+		self.enabled = False
+
+
 class BackendRecorder(Backend):
 	GET = "get"
 	SET = "set"
@@ -136,11 +697,11 @@ class BackendRecorder(Backend):
 
 	def __init__(self, backend):
 		self.backend = backend
-		self.log = []
+		self.log = deque()
 	def pop(self):
-		return self.log.pop(0)
+		return self.log.popleft()
 	def pop_nodata(self):
-		return self.log.pop(0)[:-1]
+		return self.log.popleft()[:-1]
 	def empty(self):
 		return not len(self.log)
 	def get_bits(self, start, length):
@@ -155,4 +716,4 @@ class BackendRecorder(Backend):
 		return self.backend.begin_update(start, length, mode)
 	def end_update(self, start, length, mode):
 		self.log.append((self.END, start, length, mode))
-		return self.backend.begin_update(start, length, mode)
+		return self.backend.end_update(start, length, mode)
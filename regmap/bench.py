@@ -0,0 +1,403 @@
+"""
+Micro-benchmarks for register accessors and backends.
+
+Run with:
+	python -m regmap.bench [-k PATTERN] [--json FILE] [--compare BASELINE]
+
+Results are rates (operations per second) unless the name says otherwise.
+--json writes them out, along with the interpreter and platform; a later
+run given that file with --compare reports each change, and exits with
+status 1 if anything regressed by more than --threshold.
+"""
+
+import gc
+import os
+import re
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import timeit
+import unittest
+from .types import *
+from .backends import *
+from .mmap_be import MmapBackend
+from .pipeline import FakeTransport, PipelinedBackend
+
+def rate(func, number=20000, repeat=3):
+	"""Return the best observed rate of func() calls per second"""
+	best = min(timeit.repeat(func, number=number, repeat=repeat))
+	return number / best
+
+def bench_map():
+	return Register("bench", defs = [
+		Register("reg", defs = [
+			Register("field", 8),
+			Register("flag", 1, enum=("no", "yes")),
+		], bit_length=32),
+	])
+
+class LegacyNamedInt(Register):
+	"""Register whose values get a brand new named-int type on every read"""
+	class Instance(RegisterInstance):
+		def _i2h(self, value, raw=None):
+			return named_int_factory(self._reg, int if value < sys.maxint else long)(value)
+
+def bench_get():
+	"""Reads per second of a single field _get()"""
+	res = {}
+	m = bench_map()(IntBackend(0x1a5), magic=False)
+	legacy = Register("bench", defs = [
+		Register("reg", defs = [
+			LegacyNamedInt("field", 8),
+		], bit_length=32),
+	])(IntBackend(0x1a5), magic=False)
+	res['get.legacy'] = rate(legacy.reg.field._get)
+	res['get.named'] = rate(m.reg.field._get)
+	res['get.raw'] = rate(lambda: m.reg.field._get(raw=True))
+	res['get.enum'] = rate(m.reg.flag._get)
+	return res
+
+def wide_map(nregs, nfields=8, width=4):
+	"""A map of @nregs registers with @nfields fields each"""
+	fields = [Register("f%d" % k, width) for k in xrange(nfields)]
+	return Register("wide", defs = [
+		Register("r%d" % k, defs=fields) for k in xrange(nregs)
+	])
+
+def bench_instantiate():
+	"""Instantiations per second of a 10k-field map, eager and lazy"""
+	reg = wide_map(1250)
+	be = IntBackend()
+	return {
+		'instantiate.eager': rate(lambda: reg(be), number=3),
+		'instantiate.lazy': rate(lambda: reg(be, lazy=True), number=300),
+	}
+
+def bench_find_reg():
+	"""Reverse lookups per second on a 100k-field map"""
+	m = wide_map(12500)(IntBackend())
+	m._find_reg(0)
+	end = m._bit_length
+	return {
+		'find_reg': rate(lambda: m._find_reg(end - 1)),
+		'find_regs': rate(lambda: list(m._find_regs(end // 2, 64))),
+	}
+
+class CountingBackend(Backend):
+	"""Count the get_bits()/set_bits() calls made to a backend"""
+	def __init__(self, backend):
+		self.backend = backend
+		self.gets = self.sets = 0
+	def get_bits(self, start, length):
+		self.gets += 1
+		return self.backend.get_bits(start, length)
+	def set_bits(self, start, length, value):
+		self.sets += 1
+		return self.backend.set_bits(start, length, value)
+
+def bench_getall():
+	"""_getall() of a 32-field register block: rate and backend reads per call"""
+	be = CountingBackend(IntBackend(0x123456789abcdef))
+	m = wide_map(4, 8)(be)
+	m._getall()
+	res = {'getall.backend_reads': be.gets}
+	res['getall'] = rate(m._getall, number=2000)
+	res['getall_flat'] = rate(m._getall_flat, number=2000)
+	return res
+
+class LegacyMmapBackend(MmapBackend):
+	"""MmapBackend with the original byte-by-byte conversion loops"""
+	def set_bits(self, start, length, value):
+		bstart = start / 8
+		blen = length / 8
+		bytes = []
+		for k in xrange(blen):
+			bytes.append(value & 0xff)
+			value >>= 8
+		if sys.byteorder != 'little':
+			bytes = reversed(bytes)
+		self.mm[bstart:bstart + blen] = str(bytearray(bytes))
+	def get_bits(self, start, length):
+		bstart = start / 8
+		blen = length / 8
+		value = 0
+		bytes = bytearray(self.mm[bstart:bstart + blen])
+		if sys.byteorder == 'little':
+			bytes = reversed(bytes)
+		for b in bytes:
+			value <<= 8
+			value |= b
+		return value
+
+def tmpfile_mapping(size=4096):
+	"""Return a temporary file of @size bytes, suitable for MmapBackend"""
+	fp = tempfile.TemporaryFile()
+	fp.write('\0' * size)
+	fp.flush()
+	return fp
+
+def bench_mmap():
+	"""MmapBackend accesses per second, original loop vs. fast paths"""
+	fp = tmpfile_mapping()
+	res = {}
+	for name, cls in (('legacy', LegacyMmapBackend), ('fast', MmapBackend)):
+		be = cls(fp)
+		for width in (8, 32, 64, 24, 128):
+			res['mmap.%s.get%d' % (name, width)] = rate(lambda: be.get_bits(64, width))
+			res['mmap.%s.set%d' % (name, width)] = rate(lambda: be.set_bits(64, width, 0x5a))
+	return res
+
+def bench_pipeline(latency=0.001, reads=256):
+	"""Field reads per second over a transport with 1ms latency, by pipeline depth"""
+	res = {}
+	for depth in (1, 4, 16, 64):
+		m = wide_map(4, 8)(PipelinedBackend(FakeTransport(IntBackend(), latency), depth))
+		fields = [f for r in m._defs for f in r._defs]
+		def run():
+			futures = [fields[k % len(fields)]._get_async() for k in xrange(reads)]
+			for fut in futures:
+				fut.result()
+		res['pipeline.depth%d' % depth] = rate(run, number=1, repeat=3) * reads
+	return res
+
+SIZES = (16, 1024) # registers
+WIDTHS = (1, 8, 32) # bits per field
+
+def sized_map(nregs, width):
+	"""A map of @nregs 32-bit registers (or one field, if wider) of @width-bit fields"""
+	return wide_map(nregs, max(1, 32 // width), width)
+
+def backend_stacks(size):
+	"""Return (name, backend) pairs for the commonly stacked backends, @size bytes each"""
+	fp = tmpfile_mapping(size)
+	return [
+		('int', IntBackend()),
+		('granular', GranularBackend(IntBackend())),
+		('caching', CachingBackend(GranularBackend(IntBackend()))),
+		('mmap', GranularBackend(MmapBackend(fp))),
+	]
+
+def bench_access(number=5000):
+	"""Field accesses per second, by backend stack, map size and field width"""
+	res = {}
+	for nregs in SIZES:
+		for width in WIDTHS:
+			reg = sized_map(nregs, width)
+			size = max(4096, reg._bit_length // 8)
+			for stack, be in backend_stacks(size):
+				m = reg(be)
+				last = m._defs[-1]
+				field = last._defs[-1]
+				magic = reg(be, magic=True)
+				mreg = getattr(magic, last._name)
+				fname = field._name
+				def rmw():
+					with rmw_access(last) as r:
+						field._set(field._get() ^ 1)
+				prefix = 'access.%s.n%d.w%d.' % (stack, nregs, width)
+				res[prefix + 'get'] = rate(field._get, number)
+				res[prefix + 'set'] = rate(lambda: field._set(1), number)
+				res[prefix + 'rmw'] = rate(rmw, number)
+				res[prefix + 'magic_get'] = rate(lambda: getattr(mreg, fname), number)
+				res[prefix + 'magic_set'] = rate(lambda: setattr(mreg, fname, 1), number)
+	return res
+
+def bench_getall_sizes():
+	"""_getall() calls per second, by map size and field width"""
+	res = {}
+	for nregs in SIZES:
+		for width in WIDTHS:
+			m = sized_map(nregs, width)(IntBackend())
+			res['getall.n%d.w%d' % (nregs, width)] = rate(m._getall, number=max(1, 20000 // nregs), repeat=3)
+	return res
+
+def bench_find_reg_sizes():
+	"""Reverse lookups per second, by map size and field width"""
+	res = {}
+	for nregs in SIZES:
+		for width in WIDTHS:
+			m = sized_map(nregs, width)(IntBackend())
+			end = m._bit_length
+			m._find_reg(0)
+			res['find_reg.n%d.w%d' % (nregs, width)] = rate(lambda: m._find_reg(end - 1), 5000)
+	return res
+
+class LegacyMagic(object):
+	"""The original Magic: a new proxy for every hop, every time"""
+	def __init__(self, reg):
+		self.__dict__['_reg'] = reg
+	def __getattr__(self, attr):
+		sub = getattr(self._reg, attr)
+		if sub._defs:
+			return LegacyMagic(sub)
+		return sub._get()
+	def __setattr__(self, attr, value):
+		getattr(self._reg, attr)._set(value)
+
+def bench_magic():
+	"""Chained field reads and writes per second: plain API, original Magic and cached Magic"""
+	reg = Register("bench", defs = [
+		Register("foo", defs = [
+			Register("bar", defs = [
+				Register("baz", 8),
+			]),
+		]),
+	])
+	m = reg(IntBackend(0x5a), raw=True)
+	legacy = LegacyMagic(m)
+	magic = m._magic(True)
+	def plain_set():
+		m.foo.bar.baz._set(1)
+	def legacy_set():
+		legacy.foo.bar.baz = 1
+	def magic_set():
+		magic.foo.bar.baz = 1
+	res = {}
+	for name, get, set in (
+			('plain', lambda: m.foo.bar.baz._get(), plain_set),
+			('legacy', lambda: legacy.foo.bar.baz, legacy_set),
+			('cached', lambda: magic.foo.bar.baz, magic_set)):
+		res['magic.%s.get' % name] = rate(get)
+		res['magic.%s.set' % name] = rate(set)
+	return res
+
+def bench_codegen():
+	"""Field reads and writes per second: tree instance, Magic and generated code"""
+	from .codegen import load
+	reg = bench_map()
+	be = IntBackend(0x1a5)
+	m = reg(be)
+	magic = reg(be, magic=True)
+	dev = load(reg)(be)
+	field = m.reg.field
+	mreg = magic.reg
+	def magic_set():
+		mreg.field = 1
+	def gen_set():
+		dev.reg.field = 1
+	return {
+		'codegen.tree.get': rate(lambda: field._get(raw=True)),
+		'codegen.tree.set': rate(lambda: field._set(1)),
+		'codegen.magic.get': rate(lambda: mreg.field),
+		'codegen.magic.set': rate(magic_set),
+		'codegen.generated.get': rate(lambda: dev.reg.field),
+		'codegen.generated.set': rate(gen_set),
+	}
+
+def rss():
+	"""Return the resident set size of this process, in bytes (Linux only)"""
+	with open('/proc/self/statm') as fp:
+		return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def bench_memory(nregs=12500, nfields=8):
+	"""Bytes of memory per instantiated field of a 100k-field map"""
+	reg = wide_map(nregs, nfields)
+	res = {}
+	for name, kwargs in (('eager', {}), ('lazy', dict(lazy=True))):
+		gc.collect()
+		before = rss()
+		m = reg(IntBackend(), **kwargs)
+		for sub in m._defs:
+			sub._defs[0]
+		gc.collect()
+		res['memory.field.%s' % name] = float(rss() - before) / (nregs * nfields)
+		del m
+	return res
+
+BENCHMARKS = [
+	bench_get,
+	bench_instantiate,
+	bench_find_reg,
+	bench_getall,
+	bench_mmap,
+	bench_pipeline,
+	bench_memory,
+	bench_access,
+	bench_getall_sizes,
+	bench_find_reg_sizes,
+	bench_codegen,
+	bench_magic,
+]
+
+def lower_is_better(name):
+	return name.startswith('memory.') or name.endswith('.backend_reads')
+
+def run(pattern=None, out=sys.stdout):
+	"""Run the benchmarks whose function name matches @pattern; return the results"""
+	res = {}
+	for bench in BENCHMARKS:
+		if pattern and not re.search(pattern, bench.__name__):
+			continue
+		for name, value in sorted(bench().items()):
+			out.write("%-40s %12.0f\n" % (name, value))
+			out.flush()
+			res[name] = value
+	return res
+
+def compare(baseline, results, threshold=0.1):
+	"""Compare @results to @baseline; return the (name, old, new, change) regressions.
+
+	@change is the relative improvement: positive is better, whichever
+	way the metric goes."""
+	regressions = []
+	for name in sorted(set(baseline) & set(results)):
+		old, new = baseline[name], results[name]
+		if not old:
+			continue
+		change = float(new - old) / old
+		if lower_is_better(name):
+			change = -change
+		if change < -threshold:
+			regressions.append((name, old, new, change))
+	return regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="regmap micro-benchmarks")
+	parser.add_argument('-k', dest='pattern', help="only run benchmarks matching this regex")
+	parser.add_argument('--json', help="write the results to this file")
+	parser.add_argument('--compare', metavar='BASELINE', help="compare to a file written by --json")
+	parser.add_argument('--threshold', type=float, default=0.1,
+		help="relative change counted as a regression (default: %(default)s)")
+	args = parser.parse_args(argv)
+	res = run(args.pattern)
+	if args.json:
+		with open(args.json, 'w') as fp:
+			json.dump({
+				'python': sys.version.split()[0],
+				'platform': platform.platform(),
+				'time': time.time(),
+				'results': res,
+			}, fp, indent=1, sort_keys=True)
+	if args.compare:
+		with open(args.compare) as fp:
+			baseline = json.load(fp)['results']
+		regressions = compare(baseline, res, args.threshold)
+		for name, old, new, change in regressions:
+			sys.stdout.write("REGRESSION %-40s %12.0f -> %12.0f (%+.0f%%)\n" % (name, old, new, change * 100))
+		return 1 if regressions else 0
+	return 0
+
+
+class BenchTest(unittest.TestCase):
+	def test_compare(self):
+		baseline = {'get.raw': 1000.0, 'getall': 100.0, 'memory.field.lazy': 40.0, 'gone': 1.0}
+		res = {'get.raw': 850.0, 'getall': 95.0, 'memory.field.lazy': 50.0, 'new': 1.0}
+		self.assertEqual(compare(baseline, res), [
+			('get.raw', 1000.0, 850.0, -0.15),
+			('memory.field.lazy', 40.0, 50.0, -0.25),
+		])
+		self.assertEqual(compare(baseline, res, threshold=0.5), [])
+
+	def test_stacks(self):
+		for width in WIDTHS:
+			reg = sized_map(4, width)
+			for stack, be in backend_stacks(4096):
+				m = reg(be)
+				m._defs[-1]._defs[-1]._set(1)
+				self.assertEqual(m._defs[-1]._defs[-1]._get(), 1, stack)
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,303 @@
+"""
+Generate plain Python accessor modules from register maps.
+
+For a fixed hardware map, generate() writes out a module with one class
+per register that has sub-registers, and one property per field.  Bit
+offsets, masks and enum tables are baked in as constants, so an access
+is a property call and a backend call: no tree walking, getattr chains
+or Magic in between.
+
+	with open('mydev_regs.py', 'w') as fp:
+		fp.write(generate(MyMap, 'MyDev'))
+	...
+	from mydev_regs import MyDev
+	dev = MyDev(MmapBackend(...))
+	dev.reg1.field2 = 'five'
+	print dev.reg32.status1, MyDev.reg32_t.STATUS1_OFFSET
+
+Field reads return plain ints; writes take ints or enum names.  Each
+register class also has _get(), _set(), _getall() (one backend read, raw
+values) and begins an RMW update as a context manager.  Array elements
+are addressed relative to the element's base: arr[3].field.
+"""
+
+import re
+import unittest
+from .types import *
+from .backends import IntBackend, BackendRecorder
+
+def identifier(name):
+	"""Make @name usable as a Python identifier"""
+	name = re.sub(r'\W', '_', name)
+	return '_' + name if name[:1].isdigit() else name
+
+# names the generated register classes define themselves
+RESERVED = ('OFFSET', 'LENGTH', '_backend', '_get_bits', '_set_bits', '_base',
+	'_get', '_set', '_getall')
+
+class Generator(object):
+	def __init__(self):
+		self.lines = []
+		self.class_names = set()
+
+	def emit(self, indent, line=''):
+		self.lines.append('\t' * indent + line if line else '')
+
+	def class_name(self, path):
+		name = identifier('_'.join(path)) + '_t'
+		while name in self.class_names:
+			name = '_' + name
+		self.class_names.add(name)
+		return name
+
+	def check_names(self, reg, children):
+		"""Raise ValueError if the names generated for @reg's fields clash"""
+		used = dict((name, 'the class itself') for name in RESERVED)
+		def claim(name, sub):
+			if name.startswith('__') or name in used:
+				raise ValueError("%s: field %r would define %r, already used by %s" %
+					(reg._name, sub._name, name, used.get(name, 'Python')))
+			used[name] = 'field %r' % sub._name
+		for sub, sub_cls in children:
+			claim(identifier(sub._name), sub)
+			claim(sub_cls, sub)
+		for sub in reg._defs:
+			if sub._defs or isinstance(sub, RegRAZ):
+				continue
+			name = identifier(sub._name)
+			claim(name, sub)
+			for suffix in ('_OFFSET', '_LENGTH', '_MASK', '_ENUM'):
+				claim(name.upper() + suffix, sub)
+			for prefix in ('_get_', '_set_'):
+				claim(prefix + name, sub)
+
+	def pos(self, offset, relative):
+		return 'self._base + %d' % offset if relative else '%d' % offset
+
+	def decode(self, reg, offset):
+		"""Return a dict expression decoding @reg's fields from "value" """
+		items = []
+		for k, sub in enumerate(reg._defs):
+			if isinstance(sub, (RegRAZ, RegWO, RegArray)):
+				continue
+			rel = offset + reg._offsets[k]
+			if sub._defs:
+				items.append('%r: %s' % (sub._name, self.decode(sub, rel)))
+			else:
+				items.append('%r: (value >> %d) & %#x' % (sub._name, rel, (1 << sub._bit_length) - 1))
+		return '{%s}' % ', '.join(items)
+
+	def leaf(self, sub, offset, relative):
+		"""Emit the constants and the property for a leaf field"""
+		name = identifier(sub._name)
+		const = name.upper()
+		mask = (1 << sub._bit_length) - 1
+		pos = self.pos(offset, relative)
+		self.emit(1, '%s_OFFSET = %d' % (const, offset))
+		self.emit(1, '%s_LENGTH = %d' % (const, sub._bit_length))
+		self.emit(1, '%s_MASK = %#x' % (const, mask))
+		if sub._enum_i2h:
+			self.emit(1, '%s_ENUM = %r' % (const, sub._enum_i2h))
+		getter = setter = 'None'
+		if not isinstance(sub, RegWO):
+			getter = '_get_' + name
+			self.emit(1, 'def %s(self):' % getter)
+			self.emit(2, 'return self._get_bits(%s, %d)' % (pos, sub._bit_length))
+		if not isinstance(sub, RegRO):
+			setter = '_set_' + name
+			if sub._enum_i2h:
+				self.emit(1, 'def %s(self, value, _h2i=%r):' % (setter, sub._enum_h2i))
+				self.emit(2, 'value = _h2i.get(value, value)')
+			else:
+				self.emit(1, 'def %s(self, value):' % setter)
+			self.emit(2, 'if value < 0 or value > %#x:' % mask)
+			self.emit(3, "raise ValueError('value %%r out of 0..%d range' %% (value,))" % mask)
+			self.emit(2, 'self._set_bits(%s, %d, value)' % (pos, sub._bit_length))
+		self.emit(1, '%s = property(%s, %s, doc=%r)' % (name, getter, setter, sub._doc))
+
+	def array(self, sub, path, offset, relative):
+		"""Emit a class for a RegArray; return its name"""
+		elem = sub._element
+		stride = elem._bit_length
+		elem_cls = self.register(elem, path + ['elem'], 0, True) if elem._defs else None
+		cls = self.class_name(path)
+		self.emit(0, 'class %s(object):' % cls)
+		self.emit(1, '%r' % (sub._doc or 'Array of %d %s' % (sub._count, elem._name)))
+		self.emit(1, 'OFFSET = %d' % offset)
+		self.emit(1, 'COUNT = %d' % sub._count)
+		self.emit(1, 'STRIDE = %d' % stride)
+		self.emit(1, 'def __init__(self, backend, base=0):')
+		self.emit(2, 'self._backend = backend')
+		self.emit(2, 'self._base = base + %d' % offset if relative else 'self._base = %d' % offset)
+		self.emit(1, 'def __len__(self):')
+		self.emit(2, 'return %d' % sub._count)
+		self.emit(1, 'def _offset(self, k):')
+		self.emit(2, 'if k < 0:')
+		self.emit(3, 'k += %d' % sub._count)
+		self.emit(2, 'if not 0 <= k < %d:' % sub._count)
+		self.emit(3, "raise IndexError(%r)" % ('%s index out of range' % sub._name))
+		self.emit(2, 'return self._base + k * %d' % stride)
+		self.emit(1, 'def __getitem__(self, k):')
+		if elem_cls:
+			self.emit(2, 'return %s(self._backend, self._offset(k))' % elem_cls)
+		else:
+			self.emit(2, 'return self._backend.get_bits(self._offset(k), %d)' % stride)
+			self.emit(1, 'def __setitem__(self, k, value):')
+			self.emit(2, 'if value < 0 or value > %#x:' % ((1 << stride) - 1))
+			self.emit(3, "raise ValueError('value %%r out of 0..%d range' %% (value,))" % ((1 << stride) - 1))
+			self.emit(2, 'self._backend.set_bits(self._offset(k), %d, value)' % stride)
+		self.emit(0)
+		return cls
+
+	def register(self, reg, path, offset, relative=False, name=None):
+		"""Emit a class for @reg, at absolute (or, if @relative, base-relative) @offset; return its name"""
+		children = []
+		for k, sub in enumerate(reg._defs):
+			sub_offset = offset + reg._offsets[k]
+			if isinstance(sub, RegArray):
+				children.append((sub, self.array(sub, path + [sub._name], sub_offset, relative)))
+			elif sub._defs:
+				children.append((sub, self.register(sub, path + [sub._name], sub_offset, relative)))
+		self.check_names(reg, children)
+		cls = name or self.class_name(path)
+		self.emit(0, 'class %s(object):' % cls)
+		self.emit(1, '%r' % (reg._doc or reg._name))
+		self.emit(1, 'OFFSET = %d' % offset)
+		self.emit(1, 'LENGTH = %d' % reg._bit_length)
+		self.emit(1, 'def __init__(self, backend, base=0):')
+		self.emit(2, 'self._backend = backend')
+		self.emit(2, 'self._get_bits = backend.get_bits')
+		self.emit(2, 'self._set_bits = backend.set_bits')
+		if relative:
+			self.emit(2, 'self._base = base')
+		for sub, sub_cls in children:
+			self.emit(2, 'self.%s = %s(backend, %s)' % (identifier(sub._name), sub_cls,
+				'base' if relative else '0'))
+		pos = self.pos(offset, relative)
+		self.emit(1, 'def _get(self):')
+		self.emit(2, 'return self._get_bits(%s, %d)' % (pos, reg._bit_length))
+		self.emit(1, 'def _set(self, value):')
+		self.emit(2, 'self._set_bits(%s, %d, value)' % (pos, reg._bit_length))
+		self.emit(1, 'def _getall(self):')
+		self.emit(2, 'value = self._get_bits(%s, %d)' % (pos, reg._bit_length))
+		self.emit(2, 'return %s' % self.decode(reg, 0))
+		self.emit(1, 'def __enter__(self):')
+		self.emit(2, 'self._backend.begin_update(%s, %d, Backend.MODE_RMW)' % (pos, reg._bit_length))
+		self.emit(2, 'return self')
+		self.emit(1, 'def __exit__(self, type, value, traceback):')
+		self.emit(2, 'self._backend.end_update(%s, %d, Backend.MODE_RMW)' % (pos, reg._bit_length))
+		for k, sub in enumerate(reg._defs):
+			if not sub._defs and not isinstance(sub, RegRAZ):
+				self.leaf(sub, offset + reg._offsets[k], relative)
+		for sub, sub_cls in children:
+			self.emit(1, '%s = %s' % (sub_cls, sub_cls))
+		self.emit(0)
+		return cls
+
+def generate(reg, name=None):
+	"""Return the source of a module with accessor classes for the register map @reg.
+
+	The top-level class is called @name (by default, after the map);
+	instantiate it with a Backend."""
+	gen = Generator()
+	gen.emit(0, '# Generated by regmap.codegen from %r; do not edit.' % reg._name)
+	gen.emit(0)
+	gen.emit(0, 'from regmap.types import Backend')
+	gen.emit(0)
+	name = gen.register(reg, [], 0, name=name or identifier(reg._name))
+	gen.emit(0, '__all__ = [%r]' % name)
+	return '\n'.join(gen.lines)
+
+def load(reg, name=None):
+	"""Generate the accessor code for @reg and return its top-level class"""
+	name = name or identifier(reg._name)
+	namespace = {'__name__': 'generated_' + name}
+	exec(compile(generate(reg, name), '<generated %s>' % name, 'exec'), namespace)
+	return namespace[name]
+
+
+class CodegenTest(unittest.TestCase):
+	def setUp(self):
+		self.TestMap = Register("test", defs = [
+			Register("reg1", defs = [
+				Register("field1", 4),
+				Register("field2", 8, enum={5: "five"}),
+			]),
+			Register("reg2", defs = [
+				RegRO("status", 1),
+				RegWO("cmd", 1),
+			]),
+			Register("flag", 1, rel_bitpos=24),
+			RegArray("desc", 4, Register("d", defs = [
+				Register("addr", 12),
+				Register("len", 4, rel_bitpos=12),
+			]), rel_bitpos=32),
+			RegArray("words", 2, Register("w", 16)),
+		])
+
+	def test_access(self):
+		TestDev = load(self.TestMap, 'TestDev')
+		rec = BackendRecorder(IntBackend(0x1053))
+		dev = TestDev(rec)
+		self.assertEqual(dev.reg1.field1, 3)
+		self.assertEqual(rec.pop(), (rec.GET, 0, 4, 3))
+		dev.reg1.field2 = 'five'
+		self.assertEqual(rec.pop(), (rec.SET, 4, 8, 5))
+		self.assertEqual(dev.reg1._getall(), {'field1': 3, 'field2': 5})
+		self.assertEqual(rec.pop(), (rec.GET, 0, 12, 0x53))
+		self.assertEqual(dev.reg2.status, 1)
+		self.assertEqual(rec.pop(), (rec.GET, 12, 1, 1))
+		dev.reg2.cmd = 1
+		self.assertEqual(rec.pop(), (rec.SET, 13, 1, 1))
+		with self.assertRaises(AttributeError):
+			dev.reg2.cmd
+		with self.assertRaises(AttributeError):
+			dev.reg2.status = 0
+		with self.assertRaises(ValueError):
+			dev.reg1.field1 = 16
+		dev.flag = 1
+		self.assertEqual(rec.pop(), (rec.SET, 24, 1, 1))
+		self.assertEqual(TestDev.reg1_t.FIELD2_ENUM, {5: 'five'})
+		self.assertEqual(TestDev.reg1_t.FIELD2_MASK, 0xff)
+		self.assertEqual(TestDev.FLAG_OFFSET, 24)
+		self.assertTrue(rec.empty())
+
+	def test_arrays(self):
+		rec = BackendRecorder(IntBackend())
+		dev = load(self.TestMap)(rec)
+		dev.desc[2].len = 7
+		self.assertEqual(rec.pop(), (rec.SET, 32 + 2 * 16 + 12, 4, 7))
+		dev.desc[-1].addr
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 32 + 3 * 16, 12))
+		with self.assertRaises(IndexError):
+			dev.desc[4]
+		dev.words[1] = 0xabcd
+		self.assertEqual(rec.pop(), (rec.SET, 96 + 16, 16, 0xabcd))
+		self.assertEqual(dev.words[1], 0xabcd)
+		with dev.reg1 as reg:
+			reg.field1 = 1
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 96 + 16, 16))
+		self.assertEqual(rec.pop(), (rec.BEGIN, 0, 12, Backend.MODE_RMW))
+		self.assertEqual(rec.pop(), (rec.SET, 0, 4, 1))
+		self.assertEqual(rec.pop(), (rec.END, 0, 12, Backend.MODE_RMW))
+
+	def test_same_as_tree(self):
+		be = IntBackend(0x123456789abcdef)
+		dev = load(self.TestMap)(be)
+		m = self.TestMap(be)
+		self.assertEqual(dev.reg1._getall(), m.reg1._getall())
+		self.assertEqual(dev.desc[1].addr, m.desc[1].addr._get())
+
+	def test_name_clashes(self):
+		for defs in (
+			[Register("a-b", 1), Register("a_b", 1)],
+			[Register("x", 1), Register("X", 1)],
+			[Register("LENGTH", 1)],
+			[Register("_getall", 1)],
+			[Register("r", defs=[Register("f", 1)]), Register("r_t", 1)],
+		):
+			with self.assertRaisesRegexp(ValueError, "already used"):
+				generate(Register("test", defs=defs))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,396 @@
+"""
+Register maps from description files.
+
+load_json() reads maps in a small JSON schema; load_svd() reads CMSIS-SVD
+device descriptions.  Both return a Register tree, and keep the parsed,
+laid-out tree pickled in a cache directory, keyed by the SHA-1 of the
+source file, so that loading it again skips parsing and layout.
+
+JSON schema: each register is an object with
+	"name"		required
+	"bits"		width; optional if it has "fields"
+	"offset"	relative bit position (see Register's rel_bitpos)
+	"access"	"rw" (default), "ro" or "wo"
+	"enum"		{"value": "name"} or a list of names
+	"doc", "cache"	as for Register
+	"fields"	list of sub-registers
+	"count", "element"	an array of @count @element registers
+
+	Dev = load_json('dev.json')
+	Soc = load_svd('STM32F4.svd')
+	m = Soc(WindowBackend(MmapBackend(...), ...))
+"""
+
+import gc
+import os
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+import unittest
+import cPickle as pickle
+import xml.etree.cElementTree as ElementTree
+from .types import *
+from .backends import IntBackend
+
+CACHE_VERSION = 2 # bump whenever the parsers produce different trees
+
+def default_cache_dir():
+	return os.environ.get('REGMAP_CACHE') or os.path.join(os.path.expanduser('~'), '.cache', 'regmap')
+
+def load_cached(path, parse, cache_dir=None):
+	"""Return parse(data) for the contents of @path, through the on-disk cache.
+
+	@cache_dir defaults to $REGMAP_CACHE, or ~/.cache/regmap; False
+	disables caching.  A stale or unreadable cache entry is ignored."""
+	with open(path, 'rb') as fp:
+		data = fp.read()
+	# building large trees of objects triggers the cyclic garbage
+	# collector over and over, for nothing to collect
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		return _load_cached(data, parse, cache_dir)
+	finally:
+		if enabled:
+			gc.enable()
+
+def _load_cached(data, parse, cache_dir):
+	if cache_dir is False:
+		return parse(data)
+	if cache_dir is None:
+		cache_dir = default_cache_dir()
+	key = hashlib.sha1('%s:%d:' % (parse.__name__, CACHE_VERSION) + data).hexdigest()
+	cache_path = os.path.join(cache_dir, key + '.pickle')
+	try:
+		with open(cache_path, 'rb') as fp:
+			return pickle.load(fp)
+	except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError,
+			IndexError, TypeError, ValueError):
+		pass # missing, or left by another version: parse again
+	res = parse(data)
+	try:
+		os.makedirs(cache_dir)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+	fd, tmp = tempfile.mkstemp(dir=cache_dir)
+	with os.fdopen(fd, 'wb') as fp:
+		pickle.dump(res, fp, pickle.HIGHEST_PROTOCOL)
+	os.rename(tmp, cache_path)
+	return res
+
+
+ACCESS = {
+	'rw': Register,
+	'ro': RegRO,
+	'wo': RegWO,
+}
+
+def json_register(desc):
+	"""Build a Register from a JSON schema object"""
+	name = str(desc['name']) # unicode names would not do for named-int types
+	kwargs = dict(rel_bitpos=desc.get('offset'), doc=desc.get('doc'), cache=desc.get('cache'))
+	if 'count' in desc:
+		return RegArray(name, desc['count'], json_register(desc['element']), **kwargs)
+	enum = desc.get('enum', {})
+	if isinstance(enum, dict):
+		enum = dict((int(k, 0), str(v)) for k, v in enum.items())
+	else:
+		enum = [str(v) for v in enum]
+	defs = [json_register(sub) for sub in desc.get('fields', [])]
+	try:
+		cls = ACCESS[desc.get('access', 'rw')]
+	except KeyError:
+		raise ValueError("register %r: unknown access %r" % (name, desc['access']))
+	return cls(name, desc.get('bits'), defs, enum=enum, **kwargs)
+
+def parse_json(data):
+	"""Build a Register tree from a JSON document"""
+	return json_register(json.loads(data))
+
+def load_json(path, cache_dir=None):
+	return load_cached(path, parse_json, cache_dir)
+
+
+SVD_ACCESS = {
+	'read-only': RegRO,
+	'write-only': RegWO,
+	'writeOnce': RegWO,
+}
+
+def svd_int(text):
+	"""Parse an SVD scaledNonNegativeInteger"""
+	text = text.strip().lower()
+	if text.startswith('#'):
+		return int(text[1:], 2)
+	mult = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}.get(text[-1:], 1)
+	if mult != 1:
+		text = text[:-1]
+	return int(text, 0) * mult
+
+def svd_text(elem, tag, default=None):
+	text = elem.findtext(tag)
+	return default if text is None else ' '.join(text.split())
+
+def svd_field(elem, access):
+	"""Return (bit offset, Register) for a <field>"""
+	if elem.find('bitOffset') is not None:
+		lsb = svd_int(elem.findtext('bitOffset'))
+		width = svd_int(elem.findtext('bitWidth', '1'))
+	elif elem.find('lsb') is not None:
+		lsb = svd_int(elem.findtext('lsb'))
+		width = svd_int(elem.findtext('msb')) - lsb + 1
+	else:
+		msb, lsb = [svd_int(x) for x in elem.findtext('bitRange').strip('[] ').split(':')]
+		width = msb - lsb + 1
+	enum = {}
+	for value in elem.findall('enumeratedValues/enumeratedValue'):
+		text = value.findtext('value')
+		if text is None or (text.startswith('#') and 'x' in text.lower()):
+			continue # isDefault, or don't-care bits
+		enum[svd_int(text)] = svd_text(value, 'name')
+	cls = SVD_ACCESS.get(svd_text(elem, 'access', access), Register)
+	return lsb, cls(svd_text(elem, 'name'), width, rel_bitpos=lsb, enum=enum, doc=svd_text(elem, 'description'))
+
+def svd_register(elem, size, access):
+	"""Return (byte offset, Register) for a <register>"""
+	size = svd_int(elem.findtext('size', str(size)))
+	access = svd_text(elem, 'access', access)
+	fields = sorted((svd_field(f, access) for f in elem.findall('fields/field')), key=lambda f: f[0])
+	cls = SVD_ACCESS.get(access, Register)
+	reg = cls(svd_text(elem, 'name'), size, [f for lsb, f in fields], doc=svd_text(elem, 'description'))
+	return svd_int(elem.findtext('addressOffset')), reg
+
+def svd_dim(elem):
+	"""Return (byte offset, index) for each copy of a <register> or <cluster>, expanding dim"""
+	if elem.find('dim') is None:
+		return [(0, None)]
+	dim = svd_int(elem.findtext('dim'))
+	step = svd_int(elem.findtext('dimIncrement'))
+	text = svd_text(elem, 'dimIndex')
+	if text is None:
+		names = [str(k) for k in xrange(dim)]
+	elif ',' in text or '-' not in text:
+		names = [name.strip() for name in text.split(',')]
+	else:
+		first, last = [part.strip() for part in text.split('-')]
+		if first.isdigit() and last.isdigit():
+			names = [str(k) for k in xrange(int(first), int(last) + 1)]
+		elif len(first) == len(last) == 1 and first.isalpha() and last.isalpha():
+			names = [chr(k) for k in xrange(ord(first), ord(last) + 1)]
+		else:
+			raise ValueError("%s: bad dimIndex %r" % (svd_text(elem, 'name'), text))
+	if len(names) != dim:
+		raise ValueError("%s: dimIndex %r does not have %d entries" % (svd_text(elem, 'name'), text, dim))
+	return [(k * step, name) for k, name in enumerate(names)]
+
+def svd_registers(elem, size, access):
+	"""Yield (byte offset, Register) for the registers and clusters in @elem, expanding arrays.
+
+	@elem is a peripheral's <registers>, or a <cluster>; a cluster becomes
+	a Register grouping its own."""
+	for child in elem:
+		if child.tag not in ('register', 'cluster'):
+			continue
+		if child.find('alternateRegister') is not None or child.find('alternateGroup') is not None:
+			continue
+		for step, index in svd_dim(child):
+			if child.tag == 'register':
+				offset, res = svd_register(child, size, access)
+			else:
+				offset = svd_int(child.findtext('addressOffset'))
+				regs = [(sub_offset * 8, reg) for sub_offset, reg in svd_registers(child,
+					svd_text(child, 'size', size), svd_text(child, 'access', access))]
+				res = layout(svd_text(child, 'name'), regs, svd_text(child, 'description'))
+			if index is not None:
+				res._name = res._name.replace('[%s]', '%s').replace('%s', index)
+			yield offset + step, res
+
+def layout(name, items, doc=None):
+	"""Build a Register from (bit offset, Register) pairs, dropping overlapping ones"""
+	defs = []
+	end = 0
+	for offset, reg in sorted(items, key=lambda item: item[0]):
+		if offset < end:
+			continue
+		reg._rel_bitpos = offset
+		defs.append(reg)
+		end = offset + reg._bit_length
+	return Register(name, defs=defs, doc=doc)
+
+def parse_svd(data):
+	"""Build a Register tree from a CMSIS-SVD document.
+
+	Bit offset 0 is the lowest peripheral base address (see the
+	device's _base_address)."""
+	device = ElementTree.fromstring(data)
+	size = svd_text(device, 'size', '32')
+	access = svd_text(device, 'access', 'read-write')
+	elems = dict((svd_text(p, 'name'), p) for p in device.findall('peripherals/peripheral'))
+	periphs = []
+	for elem in device.findall('peripherals/peripheral'):
+		base = svd_int(elem.findtext('baseAddress'))
+		source = elems[elem.get('derivedFrom')] if elem.get('derivedFrom') else elem
+		container = source.find('registers')
+		regs = [(offset * 8, reg) for offset, reg in svd_registers([] if container is None else container,
+			svd_text(source, 'size', size), svd_text(source, 'access', access))]
+		periphs.append((base, layout(svd_text(elem, 'name'), regs, svd_text(elem, 'description'))))
+	base_address = min(base for base, periph in periphs) if periphs else 0
+	res = layout(svd_text(device, 'name'), [((base - base_address) * 8, periph) for base, periph in periphs],
+		svd_text(device, 'description'))
+	res._base_address = base_address
+	return res
+
+def load_svd(path, cache_dir=None):
+	return load_cached(path, parse_svd, cache_dir)
+
+
+SVD_TEST = """<?xml version="1.0" encoding="utf-8"?>
+<device>
+  <name>DEV</name>
+  <size>32</size>
+  <peripherals>
+    <peripheral>
+      <name>UART0</name>
+      <baseAddress>0x40001000</baseAddress>
+      <registers>
+        <register>
+          <name>CTRL</name>
+          <description>Control
+            register</description>
+          <addressOffset>0x0</addressOffset>
+          <fields>
+            <field><name>MODE</name><bitRange>[5:4]</bitRange>
+              <enumeratedValues>
+                <enumeratedValue><name>OFF</name><value>0</value></enumeratedValue>
+                <enumeratedValue><name>ON</name><value>#01</value></enumeratedValue>
+                <enumeratedValue><name>OTHER</name><isDefault>true</isDefault></enumeratedValue>
+              </enumeratedValues>
+            </field>
+            <field><name>EN</name><bitOffset>0</bitOffset><bitWidth>1</bitWidth></field>
+          </fields>
+        </register>
+        <register>
+          <name>STATUS</name>
+          <addressOffset>0x8</addressOffset>
+          <size>16</size>
+          <access>read-only</access>
+        </register>
+        <register>
+          <name>DATA%s</name>
+          <addressOffset>0xc</addressOffset>
+          <dim>2</dim>
+          <dimIncrement>4</dimIncrement>
+          <access>write-only</access>
+        </register>
+        <cluster>
+          <name>CH%s</name>
+          <addressOffset>0x20</addressOffset>
+          <dim>2</dim>
+          <dimIncrement>8</dimIncrement>
+          <dimIndex>A-B</dimIndex>
+          <register>
+            <name>CFG</name>
+            <addressOffset>0x0</addressOffset>
+          </register>
+          <register>
+            <name>CNT[%s]</name>
+            <addressOffset>0x4</addressOffset>
+            <size>8</size>
+            <dim>2</dim>
+            <dimIncrement>1</dimIncrement>
+            <dimIndex>3-4</dimIndex>
+          </register>
+        </cluster>
+      </registers>
+    </peripheral>
+    <peripheral derivedFrom="UART0">
+      <name>UART1</name>
+      <baseAddress>0x40002000</baseAddress>
+    </peripheral>
+  </peripherals>
+</device>
+"""
+
+JSON_TEST = """{"name": "dev", "fields": [
+	{"name": "ctrl", "bits": 32, "fields": [
+		{"name": "en", "bits": 1},
+		{"name": "mode", "bits": 2, "offset": 4, "enum": {"0": "off", "0x1": "on"}}
+	]},
+	{"name": "status", "bits": 8, "access": "ro", "enum": ["idle", "busy"]},
+	{"name": "desc", "count": 4, "offset": 64, "element": {"name": "d", "fields": [
+		{"name": "addr", "bits": 24}, {"name": "cmd", "bits": 8, "access": "wo"}
+	]}}
+]}
+"""
+
+class LoaderTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.cache_dir = os.path.join(self.tmpdir, 'cache')
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+	def write(self, name, data):
+		path = os.path.join(self.tmpdir, name)
+		with open(path, 'w') as fp:
+			fp.write(data)
+		return path
+
+	def test_json(self):
+		Dev = load_json(self.write('dev.json', JSON_TEST), cache_dir=False)
+		m = Dev(IntBackend(0x11 | (1 << 32)))
+		self.assertEqual(str(m.ctrl.mode._get()), 'on')
+		self.assertEqual(str(m.status._get()), 'busy')
+		self.assertEqual(m.desc._bit_offset, 64)
+		self.assertEqual(m.desc[3].addr._bit_offset, 64 + 3 * 32)
+		self.assertTrue(isinstance(m.desc[0].cmd, RegWO.Instance))
+
+	def test_svd(self):
+		Dev = load_svd(self.write('dev.svd', SVD_TEST), cache_dir=False)
+		self.assertEqual(Dev._base_address, 0x40001000)
+		self.assertEqual(Dev.UART0.CTRL._doc, 'Control register')
+		m = Dev(IntBackend(0x11))
+		self.assertEqual(m.UART1._bit_offset, 0x1000 * 8)
+		self.assertEqual(m.UART0.DATA1._bit_offset, 0x10 * 8)
+		self.assertEqual(m.UART0.STATUS._bit_length, 16)
+		self.assertEqual(str(m.UART0.CTRL.MODE._get()), 'ON')
+		self.assertEqual(m.UART0.CTRL.EN._get(), 1)
+		self.assertTrue(isinstance(m.UART1.DATA0, RegWO.Instance))
+		self.assertTrue(isinstance(m.UART1.STATUS, RegRO.Instance))
+		self.assertEqual(m.UART0.CHB._bit_offset, 0x28 * 8)
+		self.assertEqual(m.UART1.CHA.CFG._bit_offset, (0x1000 + 0x20) * 8)
+		self.assertEqual(m.UART0.CHB.CNT4._bit_offset, 0x2d * 8)
+		for index in ('A-', 'A-C', 'A,B,C', 'AA-AB'):
+			with self.assertRaisesRegexp(ValueError, "dimIndex"):
+				parse_svd(SVD_TEST.replace('<dimIndex>A-B<', '<dimIndex>%s<' % index))
+
+	def test_cache(self):
+		path = self.write('dev.json', JSON_TEST)
+		parsed = []
+		def parse_json(data):
+			parsed.append(data)
+			return json_register(json.loads(data))
+		Dev = load_cached(path, parse_json, self.cache_dir)
+		Dev(IntBackend())._get()
+		Dev2 = load_cached(path, parse_json, self.cache_dir)
+		self.assertEqual(len(parsed), 1)
+		self.assertEqual(Dev2._offsets, Dev._offsets)
+		self.assertEqual(Dev2.desc._element._index, Dev.desc._element._index)
+		m = Dev2(IntBackend(0x10))
+		self.assertEqual(str(m.ctrl.mode._get()), 'on')
+		self.write('dev.json', JSON_TEST.replace('"ctrl"', '"control"'))
+		Dev3 = load_cached(path, parse_json, self.cache_dir)
+		self.assertEqual(len(parsed), 2)
+		self.assertEqual(Dev3._defs[0]._name, 'control')
+		for garbage in ('cregmap.nonexistent\nReg\n.', 'cregmap.types\nNoSuchClass\n.', 'I1x\n.'):
+			for name in os.listdir(self.cache_dir):
+				with open(os.path.join(self.cache_dir, name), 'wb') as fp:
+					fp.write(garbage)
+			Dev4 = load_cached(path, parse_json, self.cache_dir)
+			self.assertEqual(Dev4._defs[0]._name, 'control')
+		self.assertEqual(len(parsed), 5)
+
+if __name__ == "__main__":
+	unittest.main()
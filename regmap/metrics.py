@@ -0,0 +1,184 @@
+"""
+Access counters and latency histograms.
+
+MetricsBackend wraps a backend and accounts each access to the register
+it touches: the leaf field, or the closest register containing all the
+fields touched.  Reads, writes and read-modify-write cycles (an RMW
+update, or update_bits()) are counted separately.
+
+	metrics = MetricsBackend(MmapBackend(...))
+	m = MyMap(metrics)
+	metrics.attach(m)
+	...
+	for name, kinds in metrics.snapshot().items():
+		print name, kinds['read']['count'], kinds['read']['max']
+
+When disabled, the wrapped backend's own methods are used directly.
+"""
+
+import timeit
+import unittest
+from .types import *
+from .backends import IntBackend, SwitchableBackend
+
+BUCKETS = 40 # log2(ns); the last bucket collects everything slower
+
+class MetricsBackend(SwitchableBackend):
+	"""A backend wrapper counting accesses, and timing them, per register.
+
+	Latencies are kept in log2 histograms: bucket k counts the accesses
+	that took less than 2**k nanoseconds (and at least half that)."""
+	def __init__(self, backend, root=None, clock=timeit.default_timer, enabled=True):
+		self.backend = backend
+		self.root = None
+		self.clock = clock
+		self.names = {}
+		self.stats = {}
+		self.updates = []
+		if root is not None:
+			self.attach(root)
+		if not enabled:
+			self.disable()
+
+	def attach(self, root):
+		"""Name accesses after the registers of the map instance @root"""
+		if isinstance(root, Magic):
+			root = root._reg
+		self.root = root
+		self.names = {}
+
+	def reset(self):
+		self.stats = {}
+
+	def name(self, start, length):
+		"""Return the name of the register accessed by [start, start + length)"""
+		try:
+			return self.names[start, length]
+		except KeyError:
+			pass
+		regs = list(self.root._find_regs(start, length)) if self.root is not None else []
+		if not regs:
+			name = '@%d+%d' % (start, length)
+		else:
+			common = regs[0]._long_name.split('.')
+			for reg in regs[1:]:
+				parts = reg._long_name.split('.')
+				k = 0
+				while k < min(len(common), len(parts)) and common[k] == parts[k]:
+					k += 1
+				del common[k:]
+			name = '.'.join(common)
+		self.names[start, length] = name
+		return name
+
+	def account(self, start, length, kind, elapsed):
+		name = self.name(start, length)
+		try:
+			stat = self.stats[name, kind]
+		except KeyError:
+			stat = self.stats[name, kind] = [0, 0.0, 0.0, [0] * BUCKETS]
+		stat[0] += 1
+		stat[1] += elapsed
+		if elapsed > stat[2]:
+			stat[2] = elapsed
+		stat[3][min(int(elapsed * 1e9).bit_length(), BUCKETS - 1)] += 1
+
+	def snapshot(self):
+		"""Return {name: {kind: {count, total, max, histogram}}}, kind being read, write or rmw"""
+		res = {}
+		for (name, kind), (count, total, longest, hist) in self.stats.items():
+			res.setdefault(name, {})[kind] = {
+				'count': count,
+				'total': total,
+				'max': longest,
+				'histogram': list(hist),
+			}
+		return res
+
+	def get_bits(self, start, length):
+		t = self.clock()
+		value = self.backend.get_bits(start, length)
+		self.account(start, length, 'read', self.clock() - t)
+		return value
+	def set_bits(self, start, length, value):
+		t = self.clock()
+		self.backend.set_bits(start, length, value)
+		self.account(start, length, 'write', self.clock() - t)
+	def update_bits(self, start, length, mask, value):
+		t = self.clock()
+		self.backend.update_bits(start, length, mask, value)
+		self.account(start, length, 'rmw', self.clock() - t)
+	def begin_update(self, start, length, mode):
+		self.updates.append(self.clock())
+		self.backend.begin_update(start, length, mode)
+	def end_update(self, start, length, mode):
+		try:
+			self.backend.end_update(start, length, mode)
+		finally:
+			t = self.updates.pop()
+		if mode == Backend.MODE_RMW:
+			self.account(start, length, 'rmw', self.clock() - t)
+
+
+class MetricsTest(unittest.TestCase):
+	def setUp(self):
+		self.TestMap = Register("test", defs = [
+			Register("reg1", defs = [
+				Register("field1", 4),
+				Register("field2", 8),
+			]),
+			Register("reg2", 4),
+		])
+		self.now = 0.0
+	def clock(self):
+		self.now += 0.000001
+		return self.now
+
+	def test_metrics(self):
+		metrics = MetricsBackend(IntBackend(0x123), clock=self.clock)
+		m = self.TestMap(metrics)
+		metrics.attach(m)
+		m.reg1.field1._get()
+		m.reg1.field1._get()
+		m.reg1.field2._set(5)
+		m.reg1._getall()
+		with rmw_access(m.reg1) as reg:
+			reg.field1._set(1)
+		metrics.set_bits(100, 4, 0)
+		snap = metrics.snapshot()
+		self.assertEqual(sorted(snap), ['@100+4', 'test.reg1', 'test.reg1.field1', 'test.reg1.field2'])
+		read = snap['test.reg1.field1']['read']
+		self.assertEqual(read['count'], 2)
+		self.assertAlmostEqual(read['total'], 0.000002)
+		self.assertEqual(read['histogram'][10], 2)
+		self.assertEqual(snap['test.reg1.field2'].keys(), ['write'])
+		self.assertEqual(sum(snap['test.reg1.field2']['write']['histogram']), 1)
+		self.assertEqual(snap['test.reg1']['read']['count'], 1)
+		self.assertEqual(snap['test.reg1']['rmw']['count'], 1)
+		self.assertAlmostEqual(snap['test.reg1']['rmw']['total'], 0.000003)
+		self.assertEqual(snap['test.reg1.field1']['write']['count'], 1)
+
+	def test_disabled(self):
+		be = IntBackend(0x123)
+		metrics = MetricsBackend(be, enabled=False)
+		self.assertEqual(metrics.get_bits, be.get_bits)
+		m = self.TestMap(metrics)
+		m.reg1.field1._set(1)
+		self.assertEqual(metrics.snapshot(), {})
+		metrics.enable()
+		m.reg1.field1._set(1)
+		self.assertEqual(metrics.snapshot().keys(), ['@0+4'])
+
+	def test_failed_update(self):
+		class FailingBackend(IntBackend):
+			def end_update(self, start, length, mode):
+				raise IOError("write failed")
+		metrics = MetricsBackend(FailingBackend(), clock=self.clock)
+		m = self.TestMap(metrics)
+		with self.assertRaises(IOError):
+			with rmw_access(m.reg1):
+				pass
+		self.assertEqual(metrics.updates, [])
+
+if __name__ == "__main__":
+	unittest.main()
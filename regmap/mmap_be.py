@@ -7,9 +7,25 @@ import sys
 import os
 import mmap
 import stat
+import struct
+import binascii
+from .types import Backend, Register, RegArray, numpy_module
+from .backends import GranularBackend
+
+class MmapBackend(Backend):
+	"""A backend backed by a memory-mapped file or device.
+
+	Values are stored in native byte order.  8/16/32/64-bit accesses go
+	through struct directly on the mapping; other (byte-multiple) widths
+	are converted as a whole."""
+
+	formats = {
+		1: struct.Struct('=B'),
+		2: struct.Struct('=H'),
+		4: struct.Struct('=I'),
+		8: struct.Struct('=Q'),
+	}
 
-class MmapBackend(object):
-	"""A backend backed by a memory-mapped file or device."""
 	def __init__(self, fname, size=None, offset=0):
 		if hasattr(fname, 'fileno'):
 			fd = fname.fileno()
@@ -28,28 +44,31 @@ class MmapBackend(object):
 		assert length % 8 == 0
 		bstart = start / 8
 		blen = length / 8
-		bend = bstart + blen
-		bytes = []
-		for k in xrange(blen):
-			bytes.append(value & 0xff)
-			value >>= 8
-		if sys.byteorder != 'little':
-			bytes = reversed(bytes)
-		self.mm[bstart:bend] = str(bytearray(bytes))
+		value &= (1 << length) - 1
+		fmt = self.formats.get(blen)
+		if fmt is not None:
+			fmt.pack_into(self.mm, bstart, value)
+			return
+		data = binascii.unhexlify('%0*x' % (2 * blen, value))
+		if sys.byteorder == 'little':
+			data = data[::-1]
+		self.mm[bstart:bstart + blen] = data
 	def get_bits(self, start, length):
 		assert start % 8 == 0
 		assert length % 8 == 0
 		bstart = start / 8
 		blen = length / 8
-		bend = bstart + blen
-		value = 0
-		bytes = bytearray(self.mm[bstart:bend])
+		fmt = self.formats.get(blen)
+		if fmt is not None:
+			return fmt.unpack_from(self.mm, bstart)[0]
+		if not blen:
+			return 0
+		data = self.mm[bstart:bstart + blen]
 		if sys.byteorder == 'little':
-			bytes = reversed(bytes)
-		for b in bytes:
-			value <<= 8
-			value |= b
-		return value
+			data = data[::-1]
+		return int(binascii.hexlify(data), 16)
+	def buffer(self):
+		return self.mm
 
 class MmapTest(unittest.TestCase):
 	def setUp(self):
@@ -67,6 +86,56 @@ class MmapTest(unittest.TestCase):
 		be.set_bits(8, 16, 0x55aa)
 		self.fp.seek(0)
 		self.assertEqual(self.fp.read(4).encode('hex'), 'deaa55ef')
+	def test_odd_widths(self):
+		be = MmapBackend(self.fp)
+		self.assertEqual(be.get_bits(8, 24), 0xefbead)
+		be.set_bits(0, 24, 0x123456)
+		self.assertEqual(be.get_bits(0, 32), 0xef123456)
+		be.set_bits(8, 8, 0x1ff)
+		self.assertEqual(be.get_bits(0, 32), 0xef12ff56)
+		self.assertEqual(be.get_bits(0, 0), 0)
+	def test_coalesced_buffer(self):
+		gb = GranularBackend(MmapBackend(self.fp), coalesce=True)
+		gb.set_bits(8, 8, 0x12)
+		self.assertEqual(gb.buffer()[:4], '\xde\x12\xbe\xef')
+
+@unittest.skipIf(numpy_module() is None, "NumPy not available")
+class MmapRegArrayTest(unittest.TestCase):
+	def setUp(self):
+		self.fp = os.tmpfile()
+		self.fp.write('\0' * 1024)
+		self.fp.flush()
+		self.Map = Register("test", defs = [
+			RegArray("ports", 64, Register("port", defs = [
+				Register("rx", 32),
+				Register("tx", 16),
+				Register("errors", 12),
+				Register("link", 1),
+			], bit_length=64)),
+		])
+	def test_numpy(self):
+		be = GranularBackend(MmapBackend(self.fp))
+		be.granularity = 8
+		m = self.Map(be, magic=False)
+		for k in xrange(64):
+			m.ports[k]._update(rx=k * 1000, tx=k, errors=k + 1, link=k % 2)
+		self.assertEqual(list(m.ports._column('rx')), [k * 1000 for k in xrange(64)])
+		self.assertEqual(list(m.ports._column('errors')), [k + 1 for k in xrange(64)])
+		self.assertEqual(list(m.ports._column('link')), [k % 2 for k in xrange(64)])
+		arr = m.ports._array()
+		self.assertEqual(arr.dtype.names, ('rx', 'tx'))
+		self.assertEqual(list(arr['tx']), range(64))
+		arr['rx'][5] = 42
+		self.assertEqual(m.ports[5].rx._get(), 42)
+		# the vectorized path, not the fallback
+		self.assertTrue(isinstance(m.ports._column('tx'), numpy_module().ndarray))
+	def test_numpy_coalesced(self):
+		be = GranularBackend(MmapBackend(self.fp), coalesce=True)
+		be.granularity = 8
+		m = self.Map(be, magic=True)
+		m.ports[3].errors = 0xabc
+		self.assertEqual(m.ports._reg._column('errors')[3], 0xabc)
+		self.assertEqual(m.ports._reg._array()['tx'][3], 0)
 
 if __name__ == "__main__":
 	unittest.main()
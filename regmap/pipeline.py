@@ -0,0 +1,271 @@
+"""
+Pipelined register access over slow transports.
+
+Instead of one round trip per access, asynchronous accesses return a
+Future and are queued; up to @depth outstanding requests are then sent
+to the Transport as a single batch.  This tree targets Python 2, so
+there is no asyncio: futures complete when the batch is exchanged, which
+happens when the queue is full, on sync(), or when a result is needed.
+
+	f1 = m.reg1.field1._get_async()
+	f2 = m.reg2._getall_async()
+	m.reg32._setall_async({'flag': 1})
+	print f1.result(), f2.result()
+"""
+
+import time
+import unittest
+from .types import *
+from .backends import IntBackend, BackendRecorder
+
+GET = BackendRecorder.GET
+SET = BackendRecorder.SET
+BEGIN = BackendRecorder.BEGIN
+END = BackendRecorder.END
+UPDATE = "update"
+
+class Future(object):
+	"""The result of a queued backend operation"""
+	done = False
+	def __init__(self, backend):
+		self.backend = backend
+		self.value = None
+		self.error = None
+	def set_result(self, value):
+		self.value = value
+		self.done = True
+	def set_exception(self, error):
+		"""Fail the operation: result() will raise @error"""
+		self.error = error
+		self.done = True
+	def result(self):
+		if not self.done:
+			self.backend.sync()
+		if self.error is not None:
+			raise self.error
+		return self.value
+	def map(self, func):
+		"""Return a Future for func(result)"""
+		return MappedFuture(self, func)
+
+class MappedFuture(Future):
+	"""The result of @future, passed through @func"""
+	def __init__(self, future, func):
+		super(MappedFuture, self).__init__(future.backend)
+		self.future = future
+		self.func = func
+	@property
+	def done(self):
+		return self.future.done
+	def result(self):
+		return self.func(self.future.result())
+
+
+class Transport(object):
+	"""Carries batches of backend operations to a backend, somewhere."""
+	def exchange(self, ops):
+		"""Perform @ops, a list of (op, start, length, arg) tuples, in order.
+
+		@arg is the value for SET, the mode for BEGIN/END, and a
+		(mask, value) pair for UPDATE.  Return the list of results: the
+		value read for GET, None otherwise."""
+		raise NotImplementedError()
+
+def perform(backend, ops):
+	"""Perform a batch of operations on @backend (see Transport.exchange)"""
+	results = []
+	for op, start, length, arg in ops:
+		res = None
+		if op == GET:
+			res = backend.get_bits(start, length)
+		elif op == SET:
+			backend.set_bits(start, length, arg)
+		elif op == UPDATE:
+			backend.update_bits(start, length, arg[0], arg[1])
+		elif op == BEGIN:
+			backend.begin_update(start, length, arg)
+		elif op == END:
+			backend.end_update(start, length, arg)
+		else:
+			raise ValueError("unknown operation %r" % op)
+		results.append(res)
+	return results
+
+class FakeTransport(Transport):
+	"""An in-process transport to @backend, where each exchange costs @latency seconds"""
+	def __init__(self, backend, latency=0.001, sleep=time.sleep):
+		self.backend = backend
+		self.latency = latency
+		self.sleep = sleep
+		self.round_trips = 0
+	def exchange(self, ops):
+		self.round_trips += 1
+		if self.latency:
+			self.sleep(self.latency)
+		return perform(self.backend, ops)
+
+
+class PipelinedBackend(Backend):
+	"""A backend that pipelines up to @depth outstanding operations over a Transport.
+
+	The synchronous interface works too.  Outside of updates, each access
+	is sent at once (along with whatever was queued before it).  Within a
+	begin_update() / end_update() pair, writes are queued and the batch is
+	sent by the outermost end_update() (or earlier, along with a read that
+	needs an answer).  Operations always reach the transport in the order
+	they were issued; call sync() to send asynchronous ones left queued."""
+	def __init__(self, transport, depth=16):
+		self.transport = transport
+		self.depth = depth
+		self.queue = []
+		self.futures = []
+		self.nesting = 0
+
+	def submit(self, op, start, length, arg=None):
+		"""Queue an operation; return its Future"""
+		fut = Future(self)
+		self.queue.append((op, start, length, arg))
+		self.futures.append(fut)
+		if len(self.queue) >= self.depth:
+			self.sync()
+		return fut
+	def sync(self):
+		"""Send all outstanding operations in one batch, and complete their futures"""
+		if not self.queue:
+			return
+		ops, futures = self.queue, self.futures
+		self.queue, self.futures = [], []
+		try:
+			results = self.transport.exchange(ops)
+		except Exception as e:
+			# the whole batch failed; so does every operation in it
+			for fut in futures:
+				fut.set_exception(e)
+			raise
+		for fut, res in zip(futures, results):
+			fut.set_result(res)
+
+	def get_bits_async(self, start, length):
+		return self.submit(GET, start, length)
+	def set_bits_async(self, start, length, value):
+		return self.submit(SET, start, length, value)
+	def update_bits_async(self, start, length, mask, value):
+		return self.submit(UPDATE, start, length, (mask, value))
+
+	def get_bits(self, start, length):
+		return self.get_bits_async(start, length).result()
+	def set_bits(self, start, length, value):
+		self.set_bits_async(start, length, value)
+		if not self.nesting:
+			self.sync()
+	def update_bits(self, start, length, mask, value):
+		self.update_bits_async(start, length, mask, value)
+		if not self.nesting:
+			self.sync()
+	def begin_update(self, start, length, mode):
+		self.nesting += 1
+		self.submit(BEGIN, start, length, mode)
+	def end_update(self, start, length, mode):
+		self.submit(END, start, length, mode)
+		self.nesting -= 1
+		if not self.nesting:
+			self.sync()
+
+
+class PipelineTest(unittest.TestCase):
+	def setUp(self):
+		self.TestMap = Register("test", defs = [
+			Register("reg1", defs = [
+				Register("field1", 4),
+				Register("field2", 8),
+			]),
+			Register("reg2", defs = [
+				Register("flag0", 1),
+				Register("flag1", 1, enum=("no", "yes")),
+				RegWO("cmd", 1),
+				RegRO("status", 1),
+			]),
+		])
+		self.rec = BackendRecorder(IntBackend(0x2a5))
+		self.transport = FakeTransport(self.rec, latency=0)
+		self.be = PipelinedBackend(self.transport, depth=4)
+		self.m = self.TestMap(self.be)
+
+	def test_batches(self):
+		m = self.m
+		futures = [m.reg1.field1._get_async() for k in xrange(6)]
+		self.assertEqual(self.transport.round_trips, 1)
+		self.assertFalse(futures[-1].done)
+		self.assertEqual([f.result() for f in futures], [5] * 6)
+		self.assertEqual(self.transport.round_trips, 2)
+		flag = m.reg2.flag1._get_async()
+		m.reg2._setall_async({'flag1': 'yes', 'cmd': 1})
+		everything = m._getall_async()
+		self.assertEqual(str(flag.result()), 'no')
+		self.assertEqual(self.transport.round_trips, 3)
+		self.assertEqual(str(everything.result()['reg2']['flag1']), 'yes')
+		self.assertEqual(everything.result()['reg1'], {'field1': 5, 'field2': 0x2a})
+		self.assertEqual(m.reg1.field2._get(), 0x2a)
+		self.assertEqual(self.transport.round_trips, 4)
+
+	def test_ordering(self):
+		m = self.m
+		m.reg1.field1._set_async(7)
+		self.assertEqual(self.transport.round_trips, 0)
+		# a synchronous write goes out at once, with what was queued before it
+		m.reg1.field2._set(1)
+		self.assertEqual(self.transport.round_trips, 1)
+		self.assertEqual(self.rec.pop(), (self.rec.SET, 0, 4, 7))
+		self.assertEqual(self.rec.pop(), (self.rec.SET, 4, 8, 1))
+		self.assertEqual(m.reg1._get(), 0x17)
+		self.assertEqual(self.rec.pop(), (self.rec.GET, 0, 12, 0x17))
+		with write_access(m.reg1) as reg:
+			reg.field1._set(1)
+			reg.field2._set(2)
+			self.assertEqual(self.transport.round_trips, 2)
+		self.assertEqual(self.transport.round_trips, 3)
+		self.assertEqual(self.rec.pop_nodata(), (self.rec.BEGIN, 0, 12))
+		with self.assertRaises(TypeError):
+			m.reg2.cmd._get_async()
+		with self.assertRaises(TypeError):
+			m.reg2.status._set_async(1)
+
+	def test_nothing_to_do(self):
+		m = self.m
+		for values in ({}, {'flag0': None}):
+			fut = m.reg2._setall_async(values)
+			self.assertTrue(fut.done)
+			self.assertEqual(fut.result(), None)
+		fut = m.reg2.cmd._getall_async()
+		self.assertTrue(fut.done)
+		self.assertEqual(fut.result(), None)
+		self.assertEqual(self.transport.round_trips, 0)
+
+class FailingTransport(Transport):
+	def __init__(self):
+		self.fail = True
+	def exchange(self, ops):
+		if self.fail:
+			raise IOError("link down")
+		return [0] * len(ops)
+
+class PipelineErrorTest(unittest.TestCase):
+	def test_failed_batch(self):
+		transport = FailingTransport()
+		be = PipelinedBackend(transport, depth=4)
+		first = be.get_bits_async(0, 8)
+		second = be.get_bits_async(8, 8)
+		with self.assertRaises(IOError):
+			first.result()
+		self.assertTrue(second.done)
+		with self.assertRaises(IOError):
+			second.result()
+		mapped = second.map(lambda value: value + 1)
+		self.assertTrue(mapped.done)
+		with self.assertRaises(IOError):
+			mapped.result()
+		transport.fail = False
+		self.assertEqual(be.get_bits(0, 8), 0)
+
+if __name__ == "__main__":
+	unittest.main()
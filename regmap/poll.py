@@ -0,0 +1,215 @@
+"""
+Polling for register conditions.
+
+	res = wait_for(m.reg32.status0, 1, timeout=0.5)
+	res = wait_all([(m.reg32.status1, 1), (m.dma.state, lambda v: v != 'busy')])
+	print res.polls, res.elapsed
+
+Fields that sit close together on the same backend are read with a single
+access per poll, unless that would also read a write-only register, or
+one whose cache policy is CACHE_VOLATILE (reads of which may have side
+effects).  The delay between polls grows geometrically from @interval up
+to @max_interval.
+"""
+
+import time
+import unittest
+from .types import *
+from .backends import IntBackend, BackendRecorder, RangeMap
+
+class PollResult(object):
+	"""The outcome of a wait: the last values read, the number of polls and the time taken"""
+	def __init__(self, values, polls, elapsed):
+		self.values = values
+		self.polls = polls
+		self.elapsed = elapsed
+	@property
+	def value(self):
+		return self.values[0]
+	def __repr__(self):
+		return "<PollResult %r after %d polls, %.6fs>" % (self.values, self.polls, self.elapsed)
+
+class PollTimeout(RuntimeError):
+	"""A wait timed out; @result holds the last values read"""
+	def __init__(self, result):
+		super(PollTimeout, self).__init__("condition not met after %d polls (%.6fs): %r" %
+			(result.polls, result.elapsed, result.values))
+		self.result = result
+
+def _predicate(field, cond):
+	if callable(cond):
+		return cond
+	expected = field._h2i(cond)
+	return lambda value: value == expected
+
+def _volatile(fields):
+	"""Return (root, RangeMap of its volatile registers) for the maps containing @fields"""
+	roots = {}
+	for field in fields:
+		while field._parent is not None:
+			field = field._parent
+		roots[id(field)] = field
+	res = []
+	for root in roots.values():
+		ranges = RangeMap()
+		for start, length, policy in root._cache_policies():
+			if policy == Register.CACHE_VOLATILE:
+				ranges.add(start, length, True)
+		res.append((root, ranges))
+	return res
+
+def _mergeable(end, start, max_gap, volatile):
+	"""Return whether a read ending at @end may be extended to @start"""
+	if start - end > max_gap:
+		return False
+	if start <= end:
+		return True
+	for root, ranges in volatile:
+		if ranges.lookup(end, start - end):
+			return False
+		if any(isinstance(reg._reg, RegWO) for reg in root._regs_at(end, start - end)):
+			return False
+	return True
+
+def _reads(fields, max_gap):
+	"""Group @fields into (backend, start, length, [(index, field)]) reads"""
+	groups = {}
+	for k, field in enumerate(fields):
+		if isinstance(field._reg, RegWO):
+			raise TypeError("cannot poll write-only register %r" % field._long_name)
+		groups.setdefault(id(field._backend), []).append((k, field))
+	reads = []
+	for members in groups.values():
+		members.sort(key=lambda item: item[1]._bit_offset)
+		volatile = _volatile([field for k, field in members])
+		cur = None
+		for k, field in members:
+			end = field._bit_offset + field._bit_length
+			if cur is not None and _mergeable(cur[1] + cur[2], field._bit_offset, max_gap, volatile):
+				cur[2] = max(cur[1] + cur[2], end) - cur[1]
+				cur[3].append((k, field))
+				continue
+			cur = [field._backend, field._bit_offset, field._bit_length, [(k, field)]]
+			reads.append(cur)
+	return reads
+
+def wait_all(conditions, timeout=1.0, interval=0.0001, backoff=2.0, max_interval=0.01,
+		max_gap=64, clock=time.time, sleep=time.sleep):
+	"""Poll until all (field, condition) pairs hold; return a PollResult.
+
+	A condition is either a value (enum names allowed) or a predicate
+	called with the field's value.  Raise PollTimeout after @timeout
+	seconds."""
+	fields = [field._reg if isinstance(field, Magic) else field for field, cond in conditions]
+	preds = [_predicate(field, cond) for field, (_, cond) in zip(fields, conditions)]
+	reads = _reads(fields, max_gap)
+	values = [None] * len(fields)
+	start = clock()
+	polls = 0
+	while True:
+		polls += 1
+		for backend, base, length, members in reads:
+			data = backend.get_bits(base, length)
+			for k, field in members:
+				values[k] = field._i2h((data >> (field._bit_offset - base)) & field._mask)
+		elapsed = clock() - start
+		if all(pred(value) for pred, value in zip(preds, values)):
+			return PollResult(values, polls, elapsed)
+		if elapsed >= timeout:
+			raise PollTimeout(PollResult(values, polls, elapsed))
+		sleep(min(interval, max(timeout - elapsed, 0)))
+		interval = min(interval * backoff, max_interval)
+
+def wait_for(field, cond, **kwargs):
+	"""Poll until @field satisfies @cond; see wait_all()"""
+	return wait_all([(field, cond)], **kwargs)
+
+
+class ChangingBackend(IntBackend):
+	"""An IntBackend whose value changes after a number of reads"""
+	def __init__(self, changes):
+		super(ChangingBackend, self).__init__(0)
+		self.reads = 0
+		self.changes = changes
+	def get_bits(self, start, length):
+		self.reads += 1
+		self.value = self.changes.get(self.reads, self.value)
+		return super(ChangingBackend, self).get_bits(start, length)
+
+class PollTest(unittest.TestCase):
+	def setUp(self):
+		self.TestMap = Register("test", defs = [
+			Register("ctrl", 8),
+			Register("status", defs = [
+				RegRO("done", 1),
+				RegRO("state", 2, enum=("idle", "busy", "error")),
+			], bit_length=8),
+			Register("far", 8, rel_bitpos=1024),
+		])
+		self.now = 0.0
+		self.sleeps = []
+	def clock(self):
+		return self.now
+	def sleep(self, delay):
+		self.sleeps.append(delay)
+		self.now += delay
+
+	def test_wait_for(self):
+		be = ChangingBackend({4: 0x100, 6: 0x300})
+		m = self.TestMap(be)
+		res = wait_for(m.status.done, 1, clock=self.clock, sleep=self.sleep)
+		self.assertEqual(res.polls, 4)
+		self.assertEqual(res.value, 1)
+		self.assertEqual(self.sleeps, [0.0001, 0.0002, 0.0004])
+		self.assertAlmostEqual(res.elapsed, 0.0007)
+		res = wait_for(m.status.state, 'busy', clock=self.clock, sleep=self.sleep)
+		self.assertEqual(res.polls, 2)
+		self.assertEqual(str(res.value), 'busy')
+
+	def test_batched(self):
+		rec = BackendRecorder(ChangingBackend({5: 0x301}))
+		m = self.TestMap(rec, magic=True)
+		res = wait_all([
+			(m._reg.ctrl, 1),
+			(m._reg.status.done, lambda v: v),
+			(m._reg.far, 0),
+		], clock=self.clock, sleep=self.sleep)
+		self.assertEqual(res.polls, 3)
+		self.assertEqual(res.values, [1, 1, 0])
+		for k in xrange(3):
+			self.assertEqual(sorted([rec.pop_nodata(), rec.pop_nodata()]), [(rec.GET, 0, 9), (rec.GET, 1024, 8)])
+		self.assertTrue(rec.empty())
+
+	def test_volatile_gap(self):
+		rec = BackendRecorder(IntBackend(0x101))
+		m = Register("test", defs = [
+			Register("ctrl", 8),
+			RegRO("fifo", 8, cache=Register.CACHE_VOLATILE),
+			RegRO("status", 8),
+			RegWO("cmd", 8),
+			RegRO("tail", 8),
+		])(rec)
+		res = wait_all([(m.ctrl, 1), (m.status, 0)], clock=self.clock, sleep=self.sleep)
+		self.assertEqual(sorted([rec.pop_nodata(), rec.pop_nodata()]), [(rec.GET, 0, 8), (rec.GET, 16, 8)])
+		self.assertTrue(rec.empty())
+		res = wait_all([(m.ctrl, 1), (m.fifo, 1)], clock=self.clock, sleep=self.sleep)
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 0, 16))
+		res = wait_all([(m.fifo, 1), (m.status, 0), (m.tail, 0)], clock=self.clock, sleep=self.sleep)
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 8, 16))
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 32, 8))
+		self.assertTrue(rec.empty())
+		with self.assertRaises(TypeError):
+			wait_for(m.cmd, 0)
+
+	def test_timeout(self):
+		m = self.TestMap(IntBackend())
+		with self.assertRaises(PollTimeout) as cm:
+			wait_for(m.status.state, 'error', timeout=0.1, clock=self.clock, sleep=self.sleep)
+		res = cm.exception.result
+		self.assertEqual(str(res.value), 'idle')
+		self.assertAlmostEqual(res.elapsed, 0.1)
+		self.assertEqual(max(self.sleeps), 0.01)
+		self.assertEqual(res.polls, len(self.sleeps) + 1)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,181 @@
+"""
+Remote register access.
+
+RegisterServer exposes any backend over a TCP or Unix socket; on the
+client side, RemoteBackend (or a PipelinedBackend over a SocketTransport)
+sends queued operations to it in batches, one frame per round trip.
+
+Frames are single lines of JSON: a request is {"ops": [[op, start,
+length, arg], ...]} (see pipeline.Transport), and the reply either
+{"results": [...]} or {"error": "..."}.
+
+The server does no authentication or encryption: anyone who can connect
+can read and write the backend.  Listen on a Unix socket or on localhost,
+and reach it through an SSH tunnel (or similar) from other hosts.
+
+	server = RegisterServer(MmapBackend('/dev/mem', ...), '/run/regmap.sock').start()
+	...
+	m = MyMap(GranularBackend(RemoteBackend('/run/regmap.sock')))
+"""
+
+import os
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import SocketServer
+from .types import *
+from .backends import IntBackend, BackendRecorder
+from .pipeline import PipelinedBackend, Transport, perform
+
+class RemoteError(RuntimeError):
+	"""An operation failed on the server"""
+	pass
+
+class RegisterRequestHandler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		server = self.server.regmap
+		for line in self.rfile:
+			try:
+				ops = json.loads(line)['ops']
+				with server.lock:
+					server.frames += 1
+					reply = {'results': perform(server.backend, ops)}
+			except Exception as e:
+				reply = {'error': '%s: %s' % (type(e).__name__, e)}
+			self.wfile.write(json.dumps(reply) + '\n')
+			self.wfile.flush()
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class ThreadingUnixStreamServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+class RegisterServer(object):
+	"""Serve @backend on @address: a (host, port) tuple for TCP, or a Unix socket path.
+
+	Each frame is performed under a lock, so concurrent clients see
+	each other's batches as atomic."""
+	def __init__(self, backend, address):
+		self.backend = backend
+		self.lock = threading.Lock()
+		self.frames = 0
+		cls = ThreadingTCPServer if isinstance(address, tuple) else ThreadingUnixStreamServer
+		self.server = cls(address, RegisterRequestHandler)
+		self.server.regmap = self
+		self.address = self.server.server_address
+		self.thread = None
+
+	def serve_forever(self, poll_interval=0.5):
+		self.server.serve_forever(poll_interval)
+	def start(self, poll_interval=0.5):
+		"""Serve from a background thread"""
+		self.thread = threading.Thread(target=self.serve_forever, args=(poll_interval,))
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+	def shutdown(self):
+		if self.thread is not None:
+			self.server.shutdown()
+			self.thread.join()
+		self.server.server_close()
+
+
+class SocketTransport(Transport):
+	"""A Transport to a RegisterServer at @address"""
+	def __init__(self, address):
+		family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+		self.sock = socket.socket(family, socket.SOCK_STREAM)
+		self.sock.connect(address)
+		if family == socket.AF_INET:
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.rfile = self.sock.makefile('rb')
+		self.round_trips = 0
+	def exchange(self, ops):
+		self.round_trips += 1
+		self.sock.sendall(json.dumps({'ops': ops}) + '\n')
+		line = self.rfile.readline()
+		if not line:
+			raise RemoteError("connection closed by server")
+		reply = json.loads(line)
+		if 'error' in reply:
+			raise RemoteError(reply['error'])
+		return reply['results']
+	def close(self):
+		self.rfile.close()
+		self.sock.close()
+
+class RemoteBackend(PipelinedBackend):
+	"""A backend talking to a RegisterServer at @address.
+
+	Outside of updates, each access is one round trip; updates are
+	batched (see PipelinedBackend)."""
+	def __init__(self, address, depth=256):
+		super(RemoteBackend, self).__init__(SocketTransport(address), depth)
+
+	def close(self):
+		self.sync()
+		self.transport.close()
+
+
+class RemoteTest(unittest.TestCase):
+	def setUp(self):
+		self.TestMap = Register("test", defs = [
+			Register("reg1", defs = [
+				Register("field1", 4),
+				Register("field2", 8, enum={5: "five"}),
+			]),
+			Register("reg2", 4),
+		])
+		self.tmpdir = tempfile.mkdtemp()
+		self.rec = BackendRecorder(IntBackend(0x55))
+		self.servers = []
+		self.clients = []
+	def tearDown(self):
+		for client in self.clients:
+			client.close()
+		for server in self.servers:
+			server.shutdown()
+		shutil.rmtree(self.tmpdir)
+
+	def connect(self, address):
+		server = RegisterServer(self.rec, address).start(poll_interval=0.01)
+		self.servers.append(server)
+		client = RemoteBackend(server.address)
+		self.clients.append(client)
+		return server, client
+
+	def check_access(self, address):
+		server, client = self.connect(address)
+		m = self.TestMap(client, magic=True)
+		self.assertEqual(m.reg1.field1, 5)
+		self.assertEqual(server.frames, 1)
+		m.reg1.field2 = 'five'
+		self.assertEqual(server.frames, 2)
+		with m.reg1 as reg:
+			reg.field1 = 1
+			reg.field2 = 2
+			m.reg2 = 3
+			self.assertEqual(server.frames, 2)
+		self.assertEqual(server.frames, 3)
+		self.assertEqual(self.rec.backend.value, 0x3021)
+		self.assertEqual(m._reg._getall(), {'reg1': {'field1': 1, 'field2': 2}, 'reg2': 3})
+		self.assertEqual(server.frames, 4)
+
+	def test_tcp(self):
+		self.check_access(('127.0.0.1', 0))
+	def test_unix(self):
+		self.check_access(os.path.join(self.tmpdir, 'regs.sock'))
+
+	def test_error(self):
+		server, client = self.connect(('127.0.0.1', 0))
+		with self.assertRaisesRegexp(RemoteError, "unknown operation"):
+			client.transport.exchange([['frob', 0, 1, None]])
+		self.assertEqual(client.get_bits(0, 8), 0x55)
+
+if __name__ == "__main__":
+	unittest.main()
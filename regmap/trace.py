@@ -0,0 +1,285 @@
+"""
+Low-overhead binary tracing of backend accesses, and replay.
+
+TraceBackend records every access into a preallocated ring buffer of
+fixed-size binary records, keeping the most recent @size of them; values
+wider than a record spill over into continuation records.  When
+disabled, its accessors are the wrapped backend's own bound methods, so
+tracing costs nothing.  dump() writes the trace to a file; load() reads
+it back, and ReplayBackend serves it, deterministically, in place of the
+device.
+
+	tracer = TraceBackend(MmapBackend(...), size=1 << 20)
+	...
+	with open('regs.trace', 'wb') as fp:
+		tracer.dump(fp)
+	...
+	with open('regs.trace', 'rb') as fp:
+		m = MyMap(ReplayBackend(load(fp)))
+"""
+
+import struct
+import tempfile
+import unittest
+from .types import *
+from .backends import IntBackend, GranularBackend, BackendRecorder, SwitchableBackend
+
+GET = BackendRecorder.GET
+SET = BackendRecorder.SET
+BEGIN = BackendRecorder.BEGIN
+END = BackendRecorder.END
+UPDATE = "update"
+
+OPS = (GET, SET, BEGIN, END, UPDATE)
+MODES = (None, Backend.MODE_RMW, Backend.MODE_READ, Backend.MODE_WRITE, Backend.MODE_DISCARD)
+CONT = 0xff # op of the records carrying the rest of a wide payload
+
+# op, mode, length, start, payload (low and high 64 bits)
+# The payload is the value for GET and SET, mask | value << length for
+# UPDATE; if wider than 128 bits, the following records carry the rest.
+RECORD = struct.Struct('<BBIQQQ')
+HEADER = struct.Struct('<4sII')
+MAGIC = 'RGTR'
+VERSION = 1
+WORD_MASK = (1 << 64) - 1
+
+def _extra(op, length):
+	"""Return the number of continuation records after a record of @op, @length"""
+	bits = 2 * length if op == 4 else length if op < 2 else 0
+	return (bits - 1) // 128 if bits > 128 else 0
+
+class TraceBackend(SwitchableBackend):
+	"""A backend wrapper tracing accesses into a ring buffer of @size records"""
+	def __init__(self, backend, size=65536, enabled=True):
+		self.backend = backend
+		self.size = size
+		self.buf = bytearray(size * RECORD.size)
+		self.count = 0
+		if not enabled:
+			self.disable()
+
+	def clear(self):
+		self.count = 0
+
+	def _record(self, op, start, length, value, mode=0):
+		RECORD.pack_into(self.buf, (self.count % self.size) * RECORD.size,
+			op, mode, length, start, value & WORD_MASK, (value >> 64) & WORD_MASK)
+		self.count += 1
+		if length > 64:
+			for k in xrange(_extra(op, length)):
+				value >>= 128
+				RECORD.pack_into(self.buf, (self.count % self.size) * RECORD.size,
+					CONT, 0, 0, 0, value & WORD_MASK, (value >> 64) & WORD_MASK)
+				self.count += 1
+
+	def get_bits(self, start, length):
+		value = self.backend.get_bits(start, length)
+		self._record(0, start, length, value)
+		return value
+	def set_bits(self, start, length, value):
+		self._record(1, start, length, value)
+		return self.backend.set_bits(start, length, value)
+	def update_bits(self, start, length, mask, value):
+		self._record(4, start, length, mask | (value & mask) << length)
+		return self.backend.update_bits(start, length, mask, value)
+	def begin_update(self, start, length, mode):
+		self._record(2, start, length, 0, MODES.index(mode))
+		return self.backend.begin_update(start, length, mode)
+	def end_update(self, start, length, mode):
+		self._record(3, start, length, 0, MODES.index(mode))
+		return self.backend.end_update(start, length, mode)
+
+	def raw(self):
+		"""Return the recorded records, oldest first, as a byte string"""
+		if self.count <= self.size:
+			return str(self.buf[:self.count * RECORD.size])
+		split = (self.count % self.size) * RECORD.size
+		return str(self.buf[split:] + self.buf[:split])
+	def records(self):
+		"""Return the recorded (op, start, length, value, mode or (mask, value)) tuples, oldest first"""
+		return decode(self.raw())
+	def dump(self, fp):
+		"""Write the trace to the binary file @fp"""
+		data = self.raw()
+		fp.write(HEADER.pack(MAGIC, VERSION, len(data) // RECORD.size))
+		fp.write(data)
+
+def decode(data):
+	res = []
+	count = len(data) // RECORD.size
+	k = 0
+	while k < count:
+		op, mode, length, start, lo, hi = RECORD.unpack_from(data, k * RECORD.size)
+		k += 1
+		if op == CONT:
+			continue # the rest of a record the ring buffer overwrote
+		payload = (hi << 64) | lo
+		extra = _extra(op, length)
+		if k + extra > count:
+			raise ValueError("truncated trace")
+		for n in xrange(extra):
+			_, _, _, _, lo, hi = RECORD.unpack_from(data, (k + n) * RECORD.size)
+			payload |= ((hi << 64) | lo) << (128 * (n + 1))
+		k += extra
+		kind = OPS[op]
+		if kind in (BEGIN, END):
+			arg = MODES[mode]
+		elif kind == UPDATE:
+			arg = (payload & ((1 << length) - 1), payload >> length)
+		else:
+			arg = payload
+		res.append((kind, start, length, arg))
+	return res
+
+def load(fp):
+	"""Read a trace written by TraceBackend.dump(); return its records"""
+	magic, version, count = HEADER.unpack(fp.read(HEADER.size))
+	if magic != MAGIC:
+		raise ValueError("not a register trace")
+	if version != VERSION:
+		raise ValueError("unsupported register trace version %d (expected %d)" % (version, VERSION))
+	data = fp.read(count * RECORD.size)
+	if len(data) != count * RECORD.size:
+		raise ValueError("truncated trace")
+	return decode(data)
+
+
+class ReplayBackend(Backend):
+	"""A backend replaying a recorded trace.
+
+	Reads return the recorded values.  Every access must match the next
+	record (writes must match their value too, if @strict), otherwise
+	ValueError is raised."""
+	def __init__(self, records, strict=True):
+		self.records = records
+		self.pos = 0
+		self.strict = strict
+
+	def _next(self, op, start, length, arg, check_arg=True):
+		if self.pos >= len(self.records):
+			raise ValueError("trace exhausted at %s %d+%d" % (op, start, length))
+		rec = self.records[self.pos]
+		if rec[:3] != (op, start, length) or (check_arg and rec[3] != arg):
+			raise ValueError("trace divergence at record %d: expected %r, got %r" %
+				(self.pos, rec, (op, start, length, arg)))
+		self.pos += 1
+		return rec[3]
+	def done(self):
+		"""Return whether the whole trace has been replayed"""
+		return self.pos == len(self.records)
+
+	def get_bits(self, start, length):
+		return self._next(GET, start, length, None, False)
+	def set_bits(self, start, length, value):
+		self._next(SET, start, length, value, self.strict)
+	def update_bits(self, start, length, mask, value):
+		self._next(UPDATE, start, length, (mask, value & mask), self.strict)
+	def begin_update(self, start, length, mode):
+		self._next(BEGIN, start, length, mode)
+	def end_update(self, start, length, mode):
+		self._next(END, start, length, mode)
+
+
+class TraceTest(unittest.TestCase):
+	def setUp(self):
+		self.TestMap = Register("test", defs = [
+			Register("reg1", defs = [
+				Register("field1", 4),
+				Register("field2", 8),
+			]),
+			Register("wide", 192, rel_bitpos=32),
+		])
+
+	def exercise(self, m):
+		m.reg1.field1._set(3)
+		with rmw_access(m.reg1) as reg:
+			reg.field2._set(reg.field1._get() + 1)
+		return m._getall()
+
+	def test_trace_replay(self):
+		tracer = TraceBackend(GranularBackend(IntBackend(0xabc << 40)))
+		res = self.exercise(self.TestMap(tracer))
+		self.assertEqual(tracer.records()[:4], [
+			(SET, 0, 4, 3),
+			(BEGIN, 0, 12, Backend.MODE_RMW),
+			(GET, 0, 4, 3),
+			(SET, 4, 8, 4),
+		])
+		fp = tempfile.TemporaryFile()
+		tracer.dump(fp)
+		fp.seek(0)
+		replay = ReplayBackend(load(fp))
+		self.assertEqual(self.exercise(self.TestMap(replay)), res)
+		self.assertTrue(replay.done())
+		replay = ReplayBackend(tracer.records())
+		m = self.TestMap(replay)
+		with self.assertRaisesRegexp(ValueError, "divergence"):
+			m.reg1.field1._set(4)
+
+	def test_update(self):
+		rec = BackendRecorder(IntBackend(0xfff))
+		tracer = TraceBackend(rec)
+		m = self.TestMap(tracer)
+		m.reg1._update(field1=1, field2=2)
+		m._update(reg1=dict(field1=0), wide=1)
+		self.assertEqual(tracer.records(), [
+			(UPDATE, 0, 12, (0xfff, 0x21)),
+			(UPDATE, 0, 224, ((1 << 224) - (1 << 32) | 0xf, 1 << 32)),
+		])
+		self.assertEqual(rec.pop(), (rec.SET, 0, 12, 0x21))
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 0, 224))
+		self.assertEqual(rec.pop_nodata(), (rec.SET, 0, 224))
+		self.assertTrue(rec.empty())
+		tracer.clear()
+		m.reg1._update(field2=3)
+		replay = ReplayBackend(tracer.records())
+		self.TestMap(replay).reg1._update(field2=3)
+		self.assertTrue(replay.done())
+		with self.assertRaisesRegexp(ValueError, "divergence"):
+			self.TestMap(ReplayBackend(tracer.records())).reg1._update(field2=4)
+		tracer.disable()
+		self.assertEqual(tracer.update_bits, rec.update_bits)
+
+	def test_ring(self):
+		be = IntBackend()
+		tracer = TraceBackend(be, size=4)
+		for k in xrange(6):
+			tracer.set_bits(k, 1, 1)
+		self.assertEqual([r[1] for r in tracer.records()], [2, 3, 4, 5])
+		tracer.disable()
+		self.assertEqual(tracer.get_bits, be.get_bits)
+		tracer.set_bits(10, 1, 1)
+		self.assertEqual(tracer.count, 6)
+		tracer.enable()
+		tracer.set_bits(11, 1, 1)
+		self.assertEqual(tracer.records()[-1], (SET, 11, 1, 1))
+		tracer.set_bits(0, 256, 1 << 200)
+		self.assertEqual(tracer.records()[-1], (SET, 0, 256, 1 << 200))
+		tracer.set_bits(0, 384, 3 << 300)
+		self.assertEqual(tracer.records()[-1], (SET, 0, 384, 3 << 300))
+		tracer.set_bits(1, 1, 1)
+		tracer.set_bits(2, 1, 1)
+		# the first record of the 384-bit write was overwritten
+		self.assertEqual(tracer.records(), [(SET, 1, 1, 1), (SET, 2, 1, 1)])
+
+	def test_wide(self):
+		Map = Register("test", defs = [Register("a", 100), Register("b", 156)])
+		tracer = TraceBackend(IntBackend((0x1234 << 200) | 0x5678))
+		m = Map(tracer)
+		res = m._getall()
+		m._update(a=1, b=2)
+		fp = tempfile.TemporaryFile()
+		tracer.dump(fp)
+		fp.seek(0)
+		m = Map(ReplayBackend(load(fp)))
+		self.assertEqual(m._getall(), res)
+		m._update(a=1, b=2)
+		self.assertTrue(m._backend.done())
+		fp.seek(0)
+		fp.write('RGTR\x07')
+		fp.seek(0)
+		with self.assertRaisesRegexp(ValueError, "version 7"):
+			load(fp)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,4 +1,23 @@
+import re
 import sys
+import operator
+from bisect import bisect_left, bisect_right
+
+_numpy = False # not imported yet
+
+def numpy_module():
+	"""Return the numpy module, or None if it is not available.
+
+	NumPy is only needed by RegArray's vectorized accessors, so it is
+	imported on first use rather than with this module."""
+	global _numpy
+	if _numpy is False:
+		try:
+			import numpy
+		except ImportError:
+			numpy = None
+		_numpy = numpy
+	return _numpy
 
 class Magic(object):
 	"""Magic accessors for a Register
@@ -9,21 +28,57 @@ class Magic(object):
 	with
 		Magic(reg).foo.bar.baz = 42
 		print Magic(reg).foo.bar.baz
+
+	Each Register definition gets its own Magic subclass (see
+	magic_type_factory()).  A proxy keeps the sub-register proxies and
+	the bound leaf accessors it hands out in slots, and reg._magic(True)
+	returns the instance's own proxy, so after the first access a chain
+	like the above allocates nothing.
+
+	Other attributes starting with an underscore are set on the proxy
+	itself, as plain attributes.
 	"""
+	__slots__ = ('_reg', '__dict__')
+	def __new__(cls, reg):
+		return object.__new__(reg._reg._magic_type())
 	def __init__(self, reg):
-		self._reg = reg
+		object.__setattr__(self, '_reg', reg)
 	def __getattr__(self, attr):
-		sub = getattr(self._reg, attr)
-		if sub._defs:
-			return Magic(sub)
+		# only reached for slots not filled in yet (see magic_type_factory)
+		if attr.startswith('_magic_'):
+			kind, name = attr[7:10], attr[11:]
+		else:
+			kind, name = 'sub', attr
+		try:
+			sub = getattr(self._reg, name)
+		except AttributeError:
+			raise AttributeError("%r has no sub-register %r" % (self._reg._name, name))
+		if kind == 'get':
+			res = sub._get
+		elif kind == 'set':
+			res = sub._set
+		elif sub._defs:
+			res = sub._magic(True)
 		else:
+			# a leaf without a property: its name is not an identifier
 			return sub._get()
+		object.__setattr__(self, attr, res)
+		return res
 	def __setattr__(self, attr, value):
 		if attr.startswith('_'):
-			self.__dict__[attr] = value
+			object.__setattr__(self, attr, value)
 			return
-		sub = getattr(self._reg, attr)
-		return sub._set(value)
+		getattr(self, '_magic_set_' + attr)(value)
+	def _magic_reset(self):
+		"""Forget the sub-register proxies and accessors handed out so far"""
+		for name in type(self).__slots__:
+			try:
+				object.__delattr__(self, name)
+			except AttributeError:
+				pass
+		for name in self.__dict__.keys():
+			if name.startswith('_magic_') or name in self._reg._reg._index:
+				del self.__dict__[name]
 	def __dir__(self):
 		return dir(self._reg)
 	def __enter__(self):
@@ -31,6 +86,41 @@ class Magic(object):
 	def __exit__(self, type, value, traceback):
 		return self._reg.__exit__(type, value, traceback)
 
+class ArrayMagic(Magic):
+	"""Magic accessors for a RegArray: m.ring[1].len, m.words[2] = 5"""
+	__slots__ = ()
+	def __getitem__(self, k):
+		sub = self._reg[k]
+		return sub._magic(True) if sub._defs else sub._get()
+	def __setitem__(self, k, value):
+		self._reg[k]._set(value)
+	def __len__(self):
+		return len(self._reg._defs)
+
+IDENTIFIER = re.compile(r'[A-Za-z_]\w*$')
+
+def magic_type_factory(reg):
+	"""Return a Magic subclass for instances of @reg.
+
+	Sub-register proxies live in slots named after the sub-registers, and
+	leaves are properties whose getters are C callables, calling the
+	bound _get() kept in another slot.  Magic.__getattr__ fills the slots
+	in on first use."""
+	attrs = {}
+	slots = []
+	for name, k in reg._index.iteritems():
+		if not IDENTIFIER.match(name):
+			continue # only reachable with getattr(); see Magic.__getattr__
+		slots.append('_magic_set_' + name)
+		if reg._defs[k]._defs:
+			slots.append(name)
+		else:
+			slots.append('_magic_get_' + name)
+			attrs[name] = property(operator.methodcaller('_magic_get_' + name))
+	attrs['__slots__'] = tuple(slots)
+	base = ArrayMagic if isinstance(reg, RegArray) else Magic
+	return type("magic.%s" % reg._name, (base,), attrs)
+
 def named_int_factory(reg, base=int):
 	return type("enum.%s" % reg._name, (base,), dict(
 		__str__	= lambda self: reg._enum_i2h.get(self, base.__str__(self)),
@@ -68,13 +158,22 @@ class AtByte(AtBit):
 
 
 class Register(object):
-	"""A register definition"""
+	"""A register definition
+
+	@cache is the caching policy for reads of the register (and its
+	sub-registers): None (no preference), CACHE_VOLATILE (reads have side
+	effects or change on their own, never cache), CACHE_CONSTANT (never
+	changes), or a time-to-live in seconds.  Backends such as
+	ReadCacheBackend honour it."""
 
 	# if not None, @unused indicates the default value we write
 	# to the register if we've never read it.
 	_unused = None
 
-	def __init__(self, name, bit_length=None, defs=[], rel_bitpos=None, enum={}, doc=None):
+	CACHE_VOLATILE	= 'volatile'
+	CACHE_CONSTANT	= 'constant'
+
+	def __init__(self, name, bit_length=None, defs=[], rel_bitpos=None, enum={}, doc=None, cache=None):
 		defs = list(Modifier.modify_defs(defs))
 		if defs and (bit_length is not None):
 			sub_length = sum((reg._bit_length for reg in defs))
@@ -85,13 +184,15 @@ class Register(object):
 		self._name = name
 		self._defs = defs
 		self._doc = doc
+		self._cache = cache
 		self._rel_bitpos = rel_bitpos
 		self._enum_i2h = enum
 		self._enum_h2i = dict(((v, k) for k, v in enum.iteritems()))
+		self._named_types = {}
 		# TODO: sanity-check that enum values don't overlap
 		last_rel = 0
-		padding = []
-		for k, reg in enumerate(self._defs):
+		self._defs = []
+		for reg in defs:
 			assert not hasattr(self, reg._name)
 			setattr(self, reg._name, reg)
 			if reg._rel_bitpos is not None:
@@ -99,13 +200,12 @@ class Register(object):
 				if delta < 0:
 					raise ValueError("register %r wants relative bit-position in the past (%d)" % (reg._name, delta))
 				if delta:
-					padding.append((k, RegRAZ(
+					self._defs.append(RegRAZ(
 						"_unused_%d_%d" % (last_rel, reg._rel_bitpos),
-						delta)))
+						delta))
 				last_rel += delta
+			self._defs.append(reg)
 			last_rel += reg._bit_length
-		for k, reg in reversed(padding):
-			self._defs.insert(k, reg)
 		if self._defs:
 			if bit_length is None:
 				bit_length = last_rel
@@ -114,42 +214,191 @@ class Register(object):
 					"_unused_%d_%d" % (last_rel, bit_length),
 					bit_length - last_rel))
 		self._bit_length = bit_length
+		# offset-relative layout, shared by all instances
+		self._offsets = []
+		self._index = {}
+		rel = 0
+		for k, reg in enumerate(self._defs):
+			self._offsets.append(rel)
+			self._index[reg._name] = k
+			rel += reg._bit_length
+
+	def __getstate__(self):
+		# the named-int and Magic types are created on the fly, and cannot
+		# be pickled; _named_int() and _magic_type() bring them back
+		state = self.__dict__.copy()
+		del state['_named_types']
+		state.pop('_magic_class', None)
+		return state
+
+	def _magic_type(self):
+		"""Return the (cached) Magic subclass for instances of this register"""
+		try:
+			return self._magic_class
+		except AttributeError:
+			res = self._magic_class = magic_type_factory(self)
+			return res
+
+	def _named_int(self, base=int):
+		"""Return the (cached) named-int type for values of this register"""
+		try:
+			return self._named_types[base]
+		except KeyError:
+			res = self._named_types[base] = named_int_factory(self, base)
+			return res
+		except AttributeError:
+			self._named_types = {}
+			return self._named_int(base)
+
+	def _locate(self, path):
+		"""Return (relative bit offset, definition) of the sub-register at @path (e.g. "reg1.field2")"""
+		offset, reg = 0, self
+		for name in path.split('.'):
+			try:
+				k = reg._index[name]
+			except KeyError:
+				raise AttributeError("%r has no sub-register %r" % (reg._name, name))
+			offset += reg._offsets[k]
+			reg = reg._defs[k]
+		return offset, reg
+
+	def _walk_policies(self, offset=0):
+		"""Yield (relative bit offset, bit length, policy) for all cache policies set"""
+		if self._cache is not None:
+			yield offset, self._bit_length, self._cache
+			return
+		for k, reg in enumerate(self._defs):
+			for res in reg._walk_policies(offset + self._offsets[k]):
+				yield res
 
-	def __call__(self, backend=None, bit_offset=0, parent=None, magic=False, automagic=None):
-		"""Instantiate the register map"""
+	def _walk_leaves(self, prefix='', offset=0):
+		"""Yield (path, relative bit offset, definition) for all leaf sub-registers"""
+		for k, reg in enumerate(self._defs):
+			path = prefix + reg._name
+			if reg._defs:
+				for res in reg._walk_leaves(path + '.', offset + self._offsets[k]):
+					yield res
+			else:
+				yield path, offset + self._offsets[k], reg
+
+	def __call__(self, backend=None, bit_offset=0, parent=None, magic=False, automagic=None, raw=False, lazy=False):
+		"""Instantiate the register map.
+
+		If @raw is set, reads of registers without an enum return plain ints.
+		If @lazy is set, sub-register instances are only created when first
+		accessed."""
 		if automagic is None:
 			automagic = magic
-		res = self.Instance(self, backend, bit_offset, parent, automagic=automagic)
+		res = self.Instance(self, backend, bit_offset, parent, automagic=automagic, raw=raw, lazy=lazy)
 		return res._magic(True) if magic else res
 
+class LazyDefs(object):
+	"""The sub-register instances of a lazy RegisterInstance.
+
+	Behaves like the (read-only) list of an eager instance, but each
+	sub-register is only instantiated the first time it is accessed."""
+	def __init__(self, parent):
+		self.parent = parent
+		self.items = [None] * len(parent._reg._defs)
+	def __len__(self):
+		return len(self.items)
+	def __getitem__(self, k):
+		if isinstance(k, slice):
+			return [self[i] for i in xrange(*k.indices(len(self.items)))]
+		if k < 0:
+			k += len(self.items)
+		inst = self.items[k]
+		if inst is None:
+			inst = self.items[k] = self.parent._make_sub(k)
+			setattr(self.parent, inst._name, inst)
+		return inst
+	def __iter__(self):
+		for k in xrange(len(self.items)):
+			yield self[k]
+	def drop(self):
+		"""Forget all instantiated sub-registers"""
+		for k, inst in enumerate(self.items):
+			if inst is not None:
+				delattr(self.parent, inst._name)
+				self.items[k] = None
+
 class RegisterInstance(object):
-	"""An instantiated register.  It has a backend and a well-defined bit position within it."""
-	def __init__(self, reg, backend, bit_offset, parent, automagic=False):
+	"""An instantiated register.  It has a backend and a well-defined bit position within it.
+
+	Instances only store their base offset and backend; the layout is shared
+	with the Register definition.  Sub-registers live in the instance __dict__,
+	which (thanks to __slots__) is never allocated for leaf registers."""
+	__slots__ = ('_reg', '_backend', '_bit_offset', '_name', '_bit_length', '_mask',
+		'_parent', '_automagic', '_raw', '_lazy', '_defs', '_leaf_index', '__dict__')
+
+	def __init__(self, reg, backend, bit_offset, parent, automagic=False, raw=False, lazy=False):
 		self._reg = reg
 		self._backend = backend
 		self._bit_offset = bit_offset
-		self._defs = []
+		self._compile()
 		self._parent = parent
 		self._automagic = automagic
-		if parent:
-			self._long_name = '%s.%s' % (self._parent._long_name, self._name)
-		else:
-			self._long_name = self._name
-		for reg in self._reg._defs:
-			inst = reg(backend, bit_offset, magic=False, parent=self, automagic=self._automagic)
+		self._raw = raw
+		self._lazy = lazy
+		if not reg._defs:
+			self._defs = ()
+			return
+		if lazy:
+			self._defs = LazyDefs(self)
+			return
+		self._defs = []
+		for k, reg in enumerate(self._reg._defs):
+			inst = self._make_sub(k)
 			self._defs.append(inst)
 			assert not hasattr(self, reg._name), "sub-register %r already defined" % reg._name
 			setattr(self, reg._name, inst)
-			bit_offset += inst._bit_length
+	def __getattr__(self, attr):
+		# only reached for attributes not (yet) set on the instance
+		if attr.startswith('__') or attr in RegisterInstance.__slots__ or not self._lazy:
+			raise AttributeError(attr)
+		try:
+			k = self._reg._index[attr]
+		except KeyError:
+			raise AttributeError(attr)
+		return self._defs[k]
 	def __repr__(self):
 		return "<%s %s>" % (self._reg.__class__.__name__, self._long_name)
 
 	@property
-	def _bit_length(self):
-		return self._reg._bit_length
-	@property
-	def _name(self):
-		return self._reg._name
+	def _long_name(self):
+		if self._parent:
+			return '%s.%s' % (self._parent._long_name, self._name)
+		return self._name
+
+	def _compile(self):
+		"""Bake the definition's name, width and value mask into the instance.
+
+		The definition is immutable once instantiated, so _get()/_set()
+		need not go back to it on every access."""
+		self._name = self._reg._name
+		self._bit_length = length = self._reg._bit_length
+		self._mask = None if length is None else (1 << length) - 1
+
+	def _make_sub(self, k):
+		"""Instantiate the k-th sub-register"""
+		return self._reg._defs[k](self._backend, self._bit_offset + self._reg._offsets[k],
+			magic=False, parent=self, automagic=self._automagic, raw=self._raw, lazy=self._lazy)
+	def _drop_subregs(self):
+		"""Forget the sub-registers instantiated so far (lazy instances only).
+
+		They are re-created on their next access."""
+		if self._lazy:
+			self._defs.drop()
+			proxy = self.__dict__.get('_magic_proxy')
+			if proxy is not None: # may be cached by the ancestors' proxies
+				proxy._magic_reset()
+			reg = self
+			while reg is not None: # the ancestors index our leaves too
+				try:
+					del reg._leaf_index
+				except AttributeError:
+					pass
+				reg = reg._parent
 
 	def __call__(self, value=None):
 		"_set() if called with an argument, _get() otherwise"
@@ -158,29 +407,120 @@ class RegisterInstance(object):
 		return self._set(value)
 
 	def _set(self, value):
+		self._backend.set_bits(self._bit_offset, self._bit_length, self._encode(value))
+	def _get(self, raw=None):
+		value = self._backend.get_bits(self._bit_offset, self._bit_length)
+		return self._i2h(value, raw)
+	def _encode(self, value):
+		"""Convert @value for writing to this register; range-checked."""
 		if type(value) != int:
 			value = self._h2i(value)
-		max = (1 << self._bit_length) - 1
-		if value < 0 or value > max:
-			raise ValueError('value %r out of 0..%i range' % (value, max))
-		self._backend.set_bits(self._bit_offset, self._bit_length, value)
-	def _get(self):
-		value = self._backend.get_bits(self._bit_offset, self._bit_length)
-		return self._i2h(value)
+		if value < 0 or value > self._mask:
+			raise ValueError('value %r out of 0..%i range' % (value, self._mask))
+		return value
 	def _magic(self, always=False):
-		if always or self._automagic:
-			return Magic(self)
-		return self
+		if not (always or self._automagic):
+			return self
+		if not self._defs:
+			return Magic(self) # keep leaves free of a __dict__
+		try:
+			return self.__dict__['_magic_proxy']
+		except KeyError:
+			res = self.__dict__['_magic_proxy'] = Magic(self)
+			return res
 	def _getall(self):
-		# TODO: caching, etc.
+		"""Return the values of all sub-registers, as a nested dict.
+
+		The whole span is fetched with a single backend read."""
 		if len(self._defs):
-			return dict((reg._reg._name, reg._getall()) for reg in self._defs)
+			value = self._backend.get_bits(self._bit_offset, self._bit_length)
+			return self._decode(value, self._bit_offset)
 		else:
 			return self._get()
-
-	def _i2h(self, value):
-		"""Convert integer to human-readable value (if any)"""
-		return named_int_factory(self._reg, int if value < sys.maxint else long)(value)
+	def _getall_flat(self):
+		"""Like _getall(), but return a flat {long_name: value} dict of the leaf registers"""
+		if not len(self._defs):
+			return {self._long_name: self._getall()}
+		value = self._backend.get_bits(self._bit_offset, self._bit_length)
+		base = self._bit_offset
+		return dict((reg._long_name, reg._decode(value, base)) for reg in self._leaves()[1])
+	def _snapshot(self):
+		"""Capture the whole span with a single backend read; return a Snapshot"""
+		return Snapshot(self, self._backend.get_bits(self._bit_offset, self._bit_length))
+	def _setall(self, values):
+		"""Set several sub-registers with a single read-modify-write.
+
+		@values is a (nested) dict, shaped like the one _getall() returns;
+		None values are skipped.  Read-only registers cannot be written, so
+		leave them out (or None).  Only the span between the lowest and highest bit
+		written is accessed, and the read is skipped if that span is
+		written entirely."""
+		mask, value = self._encode_all(values)
+		if not mask:
+			return
+		lo = (mask & -mask).bit_length() - 1
+		self._backend.update_bits(self._bit_offset + lo, mask.bit_length() - lo, mask >> lo, value >> lo)
+	def _update(self, **fields):
+		"""_setall() with keyword arguments"""
+		return self._setall(fields)
+	def _encode_all(self, values):
+		"""Return (mask, value) for writing @values, relative to our bit offset"""
+		mask = value = 0
+		for name, val in values.iteritems():
+			if val is None:
+				continue
+			sub = getattr(self, name)
+			if isinstance(val, dict):
+				sub_mask, sub_val = sub._encode_all(val)
+			else:
+				sub_mask, sub_val = sub._mask, sub._encode(val)
+			delta = sub._bit_offset - self._bit_offset
+			mask |= sub_mask << delta
+			value |= sub_val << delta
+		return mask, value
+	# asynchronous variants, for backends such as PipelinedBackend;
+	# they return Futures
+	def _get_async(self, raw=None):
+		return self._backend.get_bits_async(self._bit_offset, self._bit_length).map(
+			lambda value: self._i2h(value, raw))
+	def _set_async(self, value):
+		return self._backend.set_bits_async(self._bit_offset, self._bit_length, self._encode(value))
+	def _getall_async(self):
+		if not len(self._defs):
+			return self._get_async()
+		base = self._bit_offset
+		return self._backend.get_bits_async(base, self._bit_length).map(
+			lambda value: self._decode(value, base))
+	def _setall_async(self, values):
+		mask, value = self._encode_all(values)
+		if not mask:
+			return self._completed(None)
+		lo = (mask & -mask).bit_length() - 1
+		return self._backend.update_bits_async(self._bit_offset + lo, mask.bit_length() - lo, mask >> lo, value >> lo)
+
+	def _completed(self, value):
+		"""Return a Future already holding @value"""
+		from .pipeline import Future
+		fut = Future(self._backend)
+		fut.set_result(value)
+		return fut
+
+	def _decode(self, value, base):
+		"""Decode the value of this register from @value, read at bit offset @base"""
+		if len(self._defs):
+			return dict((reg._name, reg._decode(value, base)) for reg in self._defs)
+		return self._i2h((value >> (self._bit_offset - base)) & self._mask)
+
+	def _i2h(self, value, raw=None):
+		"""Convert integer to human-readable value (if any).
+
+		In raw mode (per call, or else per instance) values of registers
+		without an enum are returned as plain ints."""
+		if raw is None:
+			raw = self._raw
+		if raw and not self._reg._enum_i2h:
+			return value
+		return self._reg._named_int(int if value < sys.maxint else long)(value)
 	def _h2i(self, value):
 		"""Convert human-readable value to integer; raise ValueError if not possible."""
 		try:
@@ -188,8 +528,9 @@ class RegisterInstance(object):
 		except KeyError:
 			return int(value) # raises ValueError
 
-	# like _set(), but allow "writing" of read-only fields.  internal only.
-	_preset = _set
+	def _preset(self, value):
+		# like _set(), but allow "writing" of read-only fields.  internal only.
+		self._backend.set_bits(self._bit_offset, self._bit_length, RegisterInstance._encode(self, value))
 
 	def _preset_reserved(self):
 		"""Write the values of reserved/unused sub-registers to the backend."""
@@ -198,6 +539,10 @@ class RegisterInstance(object):
 		for sub in self._defs:
 			sub._preset_reserved()
 
+	def _cache_policies(self):
+		"""Yield (bit offset, bit length, policy) for the cache policies in this register"""
+		return self._reg._walk_policies(self._bit_offset)
+
 	def _visit_regs(self, test_func):
 		"""Recursively visit all sub-registers and call test_func(reg) on them.
 		
@@ -210,15 +555,48 @@ class RegisterInstance(object):
 		for sub in self._defs:
 			for res in sub._visit_regs(test_func):
 				yield res
+	def _leaves(self):
+		"""Return (starts, leaves): all leaf registers, sorted by bit offset.
+
+		Built on first use and kept, so that reverse lookups are O(log n)."""
+		try:
+			return self._leaf_index
+		except AttributeError:
+			leaves = list(self._visit_regs(lambda r: True))
+			self._leaf_index = ([r._bit_offset for r in leaves], leaves)
+			return self._leaf_index
 	def _find_regs(self, bit_offset, bit_length):
 		"""Return all registers that fit in the specified bit interval."""
-		return self._visit_regs(lambda r: not (\
+		starts, leaves = self._leaves()
+		lo = max(bisect_right(starts, bit_offset) - 1, 0)
+		hi = bisect_left(starts, bit_offset + bit_length)
+		return (r for r in leaves[lo:hi] if not (\
 				(bit_offset + bit_length <= r._bit_offset) or \
 				(bit_offset >= r._bit_offset + r._bit_length)))
+	def _regs_at(self, bit_offset, bit_length):
+		"""Like _find_regs(), but walk down the layout instead of indexing all leaves.
+
+		Only the registers on the way are instantiated, which suits a few
+		lookups on a large lazy map."""
+		if not len(self._defs):
+			yield self
+			return
+		offsets = self._reg._offsets
+		rel = bit_offset - self._bit_offset
+		k = max(bisect_right(offsets, rel) - 1, 0)
+		while k < len(offsets) and offsets[k] < rel + bit_length:
+			sub = self._defs[k]
+			if sub._bit_length:
+				for reg in sub._regs_at(bit_offset, bit_length):
+					yield reg
+			k += 1
 	def _find_reg(self, bit_offset):
-		for reg in self._visit_regs(lambda r: \
-				r._bit_offset <= bit_offset < (r._bit_offset + r._bit_length)):
-			return reg
+		starts, leaves = self._leaves()
+		k = bisect_right(starts, bit_offset) - 1
+		if k >= 0:
+			reg = leaves[k]
+			if reg._bit_offset <= bit_offset < (reg._bit_offset + reg._bit_length):
+				return reg
 
 
 	def __enter__(self):
@@ -234,22 +612,179 @@ class RegRO(Register):
 	"""A read-only register"""
 	_unused = 0
 	class Instance(RegisterInstance):
+		__slots__ = ()
 		def _set(self, value):
 			raise TypeError("read-only register %r" % self._name)
+		_encode = _set
+		_set_async = _set
 
 class RegWO(Register):
 	"""A write-only register"""
 	class Instance(RegisterInstance):
-		def _get(self):
+		__slots__ = ()
+		def _get(self, raw=None):
 			raise TypeError("write-only register %r" % self._name)
+		_get_async = _get
 		def _getall(self):
-			return None
+			"""Return the last value written, if a ShadowBackend remembers it; else None"""
+			shadow_bits = getattr(self._backend, 'shadow_bits', None)
+			value = shadow_bits and shadow_bits(self._bit_offset, self._bit_length)
+			return None if value is None else self._i2h(value)
+		def _getall_async(self):
+			return self._completed(self._getall())
+		def _decode(self, value, base):
+			return self._getall()
 
 class RegRAZ(Register):
 	"""A reserved read-as-zero register."""
 	_unused = 0
 
+class RegArray(Register):
+	"""An array of @count copies of the @element register, laid out back-to-back.
 
+	Elements are accessed by index (arr[3].field) and are only instantiated
+	when first accessed.  _column() reads one field of all elements at once."""
+	def __init__(self, name, count, element, rel_bitpos=None, doc=None, cache=None):
+		super(RegArray, self).__init__(name, count * element._bit_length, rel_bitpos=rel_bitpos, doc=doc, cache=cache)
+		self._element = element
+		self._count = count
+		self._defs = [element] * count
+		self._offsets = range(0, count * element._bit_length, element._bit_length)
+
+	class Instance(RegisterInstance):
+		__slots__ = ()
+		def __init__(self, reg, backend, bit_offset, parent, automagic=False, raw=False, lazy=False):
+			super(RegArray.Instance, self).__init__(reg, backend, bit_offset, parent,
+				automagic=automagic, raw=raw, lazy=True)
+		def _make_sub(self, k):
+			inst = super(RegArray.Instance, self)._make_sub(k)
+			inst._name = '%s[%d]' % (inst._name, k)
+			return inst
+		def __getitem__(self, k):
+			return self._defs[k]
+
+		def _column(self, path):
+			"""Return the values of field @path (e.g. "status.done") of all elements.
+
+			If NumPy is available and the backend exposes its memory (see
+			Backend.buffer()), this is a vectorized operation on a view of
+			that memory, returning an array.  Otherwise the whole array is
+			fetched with a single backend read and decoded into a list."""
+			offset, field = self._reg._element._locate(path)
+			view = self._view()
+			if view is not None and field._bit_length <= 64:
+				numpy = numpy_module()
+				b0 = offset // 8
+				b1 = (offset + field._bit_length + 7) // 8
+				if b1 - b0 <= 8:
+					col = numpy.zeros(self._reg._count, numpy.uint64)
+					for k in xrange(b0, b1):
+						col |= view[:, k].astype(numpy.uint64) << numpy.uint64(8 * (k - b0))
+					col >>= numpy.uint64(offset % 8)
+					col &= numpy.uint64((1 << field._bit_length) - 1)
+					return col
+			return self._column_fallback(offset, field._bit_length)
+		def _column_fallback(self, offset, length):
+			# one read; then slice the hex digits covering each element's field
+			digits = '%x' % self._backend.get_bits(self._bit_offset, self._bit_length)
+			total = len(digits)
+			stride = self._reg._element._bit_length
+			mask = (1 << length) - 1
+			res = []
+			for k in xrange(self._reg._count):
+				lo = k * stride + offset
+				hi = lo + length
+				chunk = digits[max(total - (hi + 3) // 4, 0):max(total - lo // 4, 0)]
+				res.append((int(chunk, 16) >> (lo % 4)) & mask if chunk else 0)
+			return res
+		def _view(self):
+			"""Return a (count, element bytes) uint8 NumPy view of the array, or None"""
+			numpy = numpy_module()
+			if numpy is None or sys.byteorder != 'little':
+				return None
+			buf = self._backend.buffer()
+			stride = self._reg._element._bit_length
+			if buf is None or self._bit_offset % 8 or stride % 8:
+				return None
+			return numpy.frombuffer(buf, numpy.uint8, count=self._bit_length // 8,
+				offset=self._bit_offset // 8).reshape(self._reg._count, stride // 8)
+		def _array(self):
+			"""Return a NumPy structured array over the backend's memory, or None.
+
+			There is one column per byte-aligned 8/16/32/64-bit leaf field
+			of the element (named by its path); other fields are only
+			available through _column()."""
+			view = self._view()
+			if view is None:
+				return None
+			names, formats, offsets = [], [], []
+			for path, offset, reg in self._reg._element._walk_leaves():
+				if offset % 8 == 0 and reg._bit_length in (8, 16, 32, 64):
+					names.append(path)
+					formats.append('<u%d' % (reg._bit_length // 8))
+					offsets.append(offset // 8)
+			dtype = numpy_module().dtype(dict(names=names, formats=formats, offsets=offsets,
+				itemsize=view.shape[1]))
+			return view.view(dtype).reshape(self._reg._count)
+
+
+class Snapshot(object):
+	"""The raw value of a register instance @reg, captured at some point.
+
+	diff() works on hex strings, so comparing large maps costs time in
+	proportion to their size plus the size of the fields that changed."""
+	def __init__(self, reg, value):
+		self.reg = reg
+		self.value = value
+		self._hex = None
+
+	def __eq__(self, other):
+		return self.reg is other.reg and self.value == other.value
+	def __ne__(self, other):
+		return not self == other
+	def decode(self):
+		"""Return the values of all sub-registers, like reg._getall()"""
+		return self.reg._decode(self.value, self.reg._bit_offset)
+
+	def hex(self):
+		"""Return the value as a hex string of fixed width"""
+		if self._hex is None:
+			self._hex = '%0*x' % ((self.reg._bit_length + 3) // 4, self.value)
+		return self._hex
+	def bits(self, start, length):
+		"""Return @length bits at @start, relative to the register"""
+		digits = self.hex()
+		end = len(digits) - start // 4
+		return (int(digits[len(digits) - (start + length + 3) // 4:end], 16) >> (start % 4)) & ((1 << length) - 1)
+
+	def changed_bits(self, other):
+		"""Yield the [lo, hi) bit ranges that differ from @other, relative to the register.
+
+		Ranges are rounded out to multiples of 4 bits."""
+		if self.reg is not other.reg:
+			raise ValueError("snapshots of different registers")
+		diff = '%x' % (self.value ^ other.value)
+		top = len(diff) * 4
+		for run in re.finditer('[^0]+', diff):
+			yield top - run.end() * 4, top - run.start() * 4
+
+	def diff(self, other):
+		"""Return the leaf registers that changed since @other, sorted by bit offset.
+
+		Each change is a (long_name, old value, new value) tuple, values
+		decoded as _get() would.  Write-only registers are skipped."""
+		base = self.reg._bit_offset
+		found = {}
+		for lo, hi in self.changed_bits(other):
+			for reg in self.reg._regs_at(base + lo, hi - lo):
+				start = reg._bit_offset - base
+				if isinstance(reg, RegWO.Instance) or start in found:
+					continue
+				old = other.bits(start, reg._bit_length)
+				new = self.bits(start, reg._bit_length)
+				if old != new:
+					found[start] = (reg._long_name, reg._i2h(old), reg._i2h(new))
+		return [found[k] for k in sorted(found)]
 
 class Backend(object):
 	"""An abstract backend"""
@@ -264,8 +799,28 @@ class Backend(object):
 		raise NotImplemented()
 	def get_bits(self, start, length):
 		raise NotImplemented()
+	def update_bits(self, start, length, mask, value):
+		"""Set only the bits selected by @mask to @value.
+
+		Read-modify-write by default; the read is skipped if @mask is full."""
+		if mask != (1 << length) - 1:
+			value = self.get_bits(start, length) & ~mask | value & mask
+		self.set_bits(start, length, value)
 	def begin_update(self, start, length, mode):
 		pass # nop
+	def shadow_bits(self, start, length):
+		"""Return the last value written to write-only bits, or None if not known.
+
+		Wrappers pass this on to the backend they wrap (see ShadowBackend)."""
+		backend = getattr(self, 'backend', None)
+		if backend is None:
+			return None
+		return backend.shadow_bits(start, length)
+	def buffer(self):
+		"""Return a writable buffer over the backend's memory, if it has one.
+
+		Bit offset 0 is the start of the buffer; values are in native byte order."""
+		return None
 	def end_update(self, start, length, mode):
 		pass # nop
 
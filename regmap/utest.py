@@ -1,6 +1,10 @@
+import sys
+import tempfile
+import threading
 import unittest
 from .types import *
 from .backends import *
+from .mmap_be import MmapBackend
 
 class BaseTestCase(unittest.TestCase):
 	def setUp(self):
@@ -52,8 +56,9 @@ class SparseTestCase(unittest.TestCase):
 		])
 
 class LayoutTestCase(object):
+	lazy = False
 	def test_layout(self):
-		m = self.TestMap(magic=False)
+		m = self.TestMap(magic=False, lazy=self.lazy)
 		self.assertEqual(m.reg1._bit_offset, 0)
 		self.assertEqual(m.reg1._bit_length, 12)
 		self.assertEqual(m.reg2._bit_offset, 12)
@@ -84,12 +89,22 @@ class ClassicLayoutTestCase(BaseTestCase, LayoutTestCase):
 class SparseLayoutTestCase(SparseTestCase, LayoutTestCase):
 	pass
 
+class LazyLayoutTestCase(SparseTestCase, LayoutTestCase):
+	lazy = True
+
 class RegisterMapTest(BaseTestCase):
 	def test_reverse_lookup(self):
 		m = self.TestMap(magic=False)
 		self.assertEqual(m._find_reg(15), m.reg2.flag3)
 		self.assertEqual(set(m._find_regs(15, 1)), set([m.reg2.flag3]))
 		self.assertEqual(set(m._find_regs(14, 2)), set([m.reg2.flag2, m.reg2.flag3]))
+		self.assertEqual(list(m._find_regs(2, 12)), [m.reg1.field1, m.reg1.field2, m.reg2.flag0, m.reg2.flag1])
+		self.assertEqual(m.reg32._find_reg(8 * 0x32 + 14), m.reg32.flag)
+		self.assertEqual(m._find_reg(8 * 0x32 + 2)._name, '_unused_1_4')
+		self.assertIsNone(m._find_reg(8 * 0x34))
+		self.assertIsNone(m.reg2._find_reg(11))
+		self.assertEqual(list(m._find_regs(8 * 0x34, 8)), [])
+		self.assertEqual(m.reg2.flag1._find_reg(13), m.reg2.flag1)
 
 	def test_cosmetic(self):
 		m = self.TestMap(magic=False)
@@ -117,6 +132,23 @@ class RegisterMapTest(BaseTestCase):
 		with self.assertRaises(ValueError):
 			m.reg1._set(0x1000)
 
+	def test_named_int_cached(self):
+		be = IntBackend(0x5aa)
+		m = self.TestMap(be, magic=False)
+		self.assertIs(type(m.reg1.field1._get()), type(m.reg1.field1._get()))
+		self.assertIs(type(m.reg2.flag2._get()), type(m.reg2.flag2._get()))
+		self.assertIsNot(type(m.reg2.flag1._get()), type(m.reg2.flag2._get()))
+
+	def test_raw(self):
+		be = IntBackend(0x45aa)
+		m = self.TestMap(be, magic=False, raw=True)
+		self.assertIs(type(m.reg1.field2._get()), int)
+		self.assertEqual(m.reg1.field2._get(), 0x5a)
+		self.assertEqual(str(m.reg2.flag2._get()), 'yes')
+		m = self.TestMap(be, magic=False)
+		self.assertIsNot(type(m.reg1.field2._get()), int)
+		self.assertIs(type(m.reg1.field2._get(raw=True)), int)
+
 	def test_magic(self):
 		be = IntBackend()
 		m = self.TestMap(be, magic=True)
@@ -129,6 +161,42 @@ class RegisterMapTest(BaseTestCase):
 		m.reg2.flag2 = 'yes'
 		self.assertEqual(m.reg2._reg._get(), 4)
 
+	def test_magic_cached(self):
+		be = IntBackend()
+		m = self.TestMap(be, magic=True)
+		self.assertIs(m._reg._magic(True), m)
+		reg2 = m.reg2
+		self.assertIs(m.reg2, reg2)
+		self.assertIs(reg2, m._reg.reg2._magic(True))
+		m.reg2.flag2 = 'yes'
+		m.reg2.flag2 = 'yes'
+		self.assertEqual(str(m.reg2.flag2), 'yes')
+		self.assertEqual(reg2._magic_get_flag2, m._reg.reg2.flag2._get)
+		be.value = 0
+		self.assertEqual(m.reg2.flag2, 0)
+		m.reg2 = 4
+		self.assertEqual(m.reg2.flag2, 1)
+		with self.assertRaises(AttributeError):
+			m.reg2.flag7 = 1
+		with self.assertRaises(AttributeError):
+			m.reg2.flag7
+		with m.reg2 as r:
+			self.assertIs(r, reg2)
+		self.assertIsNot(self.TestMap(be, magic=True).reg2, reg2)
+
+	def test_magic_odd_names(self):
+		be = IntBackend(0x35)
+		m = Register("test", defs = [
+			Register("rx-fifo", 4),
+			Register("ctl.1", defs = [Register("en", 1)]),
+			Register("ok", 3),
+		])(be, magic=True)
+		self.assertEqual(getattr(m, 'rx-fifo'), 5)
+		setattr(m, 'rx-fifo', 2)
+		self.assertEqual(be.value, 0x32)
+		self.assertEqual(getattr(m, 'ctl.1').en, 1)
+		self.assertEqual(m.ok, 1)
+
 	def test_no_magic(self):
 		be = IntBackend()
 		m = self.TestMap(be, magic=False)
@@ -161,6 +229,54 @@ class RegisterMapTest(BaseTestCase):
 		self.assertEqual(n.one.reg1.field1, 7)
 		self.assertEqual(n.two.reg1.field1, 1)
 
+	def test_lazy(self):
+		be = IntBackend(0x5aa)
+		m = self.TestMap(be, magic=False, lazy=True)
+		self.assertEqual(m._defs.items, [None] * len(m._defs))
+		field = m.reg1.field2
+		self.assertIs(m.reg1.field2, field)
+		self.assertEqual(field._get(), 0x5a)
+		self.assertEqual(field._long_name, 'test.reg1.field2')
+		self.assertIsNone(m._defs.items[1])
+		self.assertEqual(m._find_reg(15)._long_name, 'test.reg2.flag3')
+		m._drop_subregs()
+		self.assertEqual(m._defs.items, [None] * len(m._defs))
+		self.assertIsNot(m.reg1.field2, field)
+		self.assertEqual(m.reg1.field2._get(), 0x5a)
+		flag3 = m._find_reg(15)
+		m.reg2._drop_subregs()
+		self.assertIsNot(m._find_reg(15), flag3)
+		self.assertIs(m._find_reg(15), m.reg2.flag3)
+		with self.assertRaises(AttributeError):
+			m.nonexistent
+
+	def test_lazy_magic(self):
+		be = IntBackend(0x5aa)
+		m = self.TestMap(be, magic=True, lazy=True)
+		reg1 = m.reg1
+		self.assertEqual(reg1.field2, 0x5a)
+		old = m._reg.reg1
+		m._reg._drop_subregs()
+		self.assertIsNot(m.reg1._reg, old)
+		self.assertIs(m.reg1._reg, m._reg.reg1)
+		old = m._reg.reg1.field2
+		m._reg.reg1._drop_subregs()
+		m.reg1.field2 = 0x12
+		self.assertIsNot(m._reg.reg1.field2, old)
+		self.assertEqual(be.value, 0x12a)
+		m._note = 'x'
+		self.assertEqual(m._note, 'x')
+
+	def test_shared_layout(self):
+		n = Register("nested", defs = [
+			Register("one", defs=self.TestMap._defs),
+			Register("two", defs=self.TestMap._defs),
+		])(IntBackend(), magic=False)
+		self.assertIs(n.one.reg1._reg, n.two.reg1._reg)
+		self.assertEqual(n.two.reg1._bit_offset - n.one.reg1._bit_offset, n.one._bit_length)
+		self.assertEqual(n.two.reg2.flag3._long_name, 'nested.two.reg2.flag3')
+		self.assertEqual(n.one.reg1.field1._defs, ())
+
 	def test_getall(self):
 		m = self.TestMap(IntBackend(), magic=False)
 		self.assertEqual(m.reg32._getall(), {
@@ -175,6 +291,28 @@ class RegisterMapTest(BaseTestCase):
 			'status3': 0,
 		})
 
+	def test_getall_single_read(self):
+		rec = BackendRecorder(IntBackend(0x45aa | (0x4001 << (8 * 0x32))))
+		m = self.TestMap(rec, magic=False)
+		res = m._getall()
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 0, 8 * 0x32 + 16))
+		self.assertTrue(rec.empty())
+		self.assertEqual(res['reg1'], {'field1': 0xa, 'field2': 0x5a})
+		self.assertEqual(str(res['reg2']['flag2']), 'yes')
+		self.assertEqual(res['reg32']['status0'], 1)
+		self.assertEqual(res['reg32']['flag'], 1)
+		self.assertIsNone(res['reg32']['cmd1'])
+		flat = m.reg2._getall_flat()
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 12, 4))
+		self.assertTrue(rec.empty())
+		self.assertEqual(flat, {
+			'test.reg2.flag0': 0,
+			'test.reg2.flag1': 0,
+			'test.reg2.flag2': 1,
+			'test.reg2.flag3': 0,
+		})
+		self.assertEqual(m.reg1.field1._getall_flat(), {'test.reg1.field1': 0xa})
+
 	def test_granular_region(self):
 		gb = GranularBackend(IntBackend())
 		self.assertEqual(gb.compute_region(0, 32), (0, 32))
@@ -197,6 +335,56 @@ class RegisterMapTest(BaseTestCase):
 		self.assertEqual(rec.pop(), (rec.GET, 0, 32, 0xbabebeef))
 		self.assertTrue(rec.empty())
 
+	def test_granular_windows(self):
+		rec = BackendRecorder(IntBackend())
+		gb = GranularBackend(rec)
+		gb.set_granularity(128, 128, 64)
+		self.assertEqual(gb.compute_region(5, 1), (0, 32))
+		self.assertEqual(gb.compute_region(130, 4), (128, 192))
+		self.assertEqual(gb.compute_region(200, 64), (192, 320))
+		gb.set_bits(192, 64, 0x1234)
+		self.assertEqual(rec.pop(), (rec.SET, 192, 64, 0x1234))
+		self.assertTrue(rec.empty())
+
+	def test_granular_coalesce(self):
+		rec = BackendRecorder(IntBackend(0xaa00))
+		gb = GranularBackend(rec, coalesce=True)
+		m = Register("test", defs = [
+			Register("reg%d" % k, 8) for k in xrange(8)
+		])(gb)
+		# without coalescing: 8 GETs + 8 SETs
+		for k in xrange(8):
+			getattr(m, "reg%d" % k)._set(k + 1)
+		self.assertTrue(rec.empty())
+		self.assertEqual(m.reg1._get(), 2)
+		self.assertTrue(rec.empty())
+		gb.flush()
+		self.assertEqual(rec.pop(), (rec.SET, 0, 64, 0x0807060504030201))
+		self.assertTrue(rec.empty())
+		# partial, neighbouring granules: one RMW
+		m.reg2._set(0x33)
+		m.reg5._set(0x66)
+		gb.flush()
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 0, 64))
+		self.assertEqual(rec.pop(), (rec.SET, 0, 64, 0x0807660504330201))
+		self.assertTrue(rec.empty())
+		# reading other bits, or distant writes, flush the queue first
+		m.reg0._set(0x11)
+		self.assertEqual(m.reg7._get(), 8)
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 0, 32))
+		self.assertEqual(rec.pop_nodata(), (rec.SET, 0, 32))
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 32, 32))
+		self.assertTrue(rec.empty())
+		gb.set_bits(256, 8, 1)
+		gb.set_bits(512, 8, 1)
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 256, 32))
+		self.assertEqual(rec.pop_nodata(), (rec.SET, 256, 32))
+		self.assertTrue(rec.empty())
+		with rmw_access(m.reg0):
+			self.assertEqual(rec.pop_nodata(), (rec.GET, 512, 32))
+			self.assertEqual(rec.pop_nodata(), (rec.SET, 512, 32))
+			self.assertEqual(rec.pop(), (rec.BEGIN, 0, 32, Backend.MODE_RMW))
+
 	def test_int_bits(self):
 		m = Register("test", defs = [
 			Register("reg128", 128),
@@ -204,6 +392,386 @@ class RegisterMapTest(BaseTestCase):
 		m.reg128._set(0xec000002 << 64)
 		self.assertEqual(m.reg128._get(), 0xec000002 << 64)
 
+class RegArrayTest(unittest.TestCase):
+	def setUp(self):
+		self.Desc = Register("desc", defs = [
+			Register("addr", 16),
+			Register("len", 12),
+			Register("flags", defs = [
+				Register("valid", 1),
+				Register("own", 1, enum=("cpu", "dev")),
+			], bit_length=4),
+		])
+		self.TestMap = Register("test", defs = [
+			Register("ctrl", 8),
+			RegArray("ring", 16, self.Desc),
+		])
+
+	def test_layout(self):
+		m = self.TestMap(IntBackend(), magic=False)
+		self.assertEqual(m.ring._bit_offset, 8)
+		self.assertEqual(m._bit_length, 8 + 16 * 32)
+		self.assertEqual(m.ring[3]._bit_offset, 8 + 3 * 32)
+		self.assertEqual(m.ring[3].flags.own._bit_offset, 8 + 3 * 32 + 29)
+		self.assertEqual(m.ring[-1]._bit_offset, 8 + 15 * 32)
+		self.assertIs(m.ring[3], m.ring[3])
+		self.assertEqual(m.ring[3].flags.own._long_name, 'test.ring.desc[3].flags.own')
+		self.assertEqual(m._find_reg(8 + 2 * 32 + 17)._long_name, 'test.ring.desc[2].len')
+		with self.assertRaises(IndexError):
+			m.ring[16]
+
+	def test_column(self):
+		be = IntBackend()
+		m = self.TestMap(be, magic=False)
+		for k in xrange(16):
+			m.ring[k]._update(addr=0x1000 + k, len=k * 3, flags={'own': k % 2})
+		self.assertEqual(list(m.ring._column('addr')), [0x1000 + k for k in xrange(16)])
+		self.assertEqual(list(m.ring._column('len')), [k * 3 for k in xrange(16)])
+		self.assertEqual(list(m.ring._column('flags.own')), [k % 2 for k in xrange(16)])
+		self.assertEqual(str(m.ring[1].flags.own._get()), 'dev')
+		with self.assertRaises(AttributeError):
+			m.ring._column('flags.foo')
+
+	def test_magic(self):
+		be = IntBackend()
+		m = Register("test", defs = [
+			RegArray("ring", 4, self.Desc),
+			RegArray("words", 2, Register("w", 16)),
+		])(be, magic=True)
+		m.ring[1].len = 5
+		self.assertEqual(m.ring[1].len, 5)
+		self.assertEqual(str(m.ring[-1].flags.own), 'cpu')
+		self.assertIs(m.ring[1], m.ring[1])
+		m.words[1] = 0xabcd
+		self.assertEqual(m.words[1], 0xabcd)
+		self.assertEqual(be.value >> (4 * 32 + 16), 0xabcd)
+		self.assertEqual(len(m.ring), 4)
+		with self.assertRaises(IndexError):
+			m.ring[4]
+
+class SetAllTest(BaseTestCase):
+	def setUp(self):
+		super(SetAllTest, self).setUp()
+		self.rec = BackendRecorder(IntBackend(0xb000))
+		self.gb = GranularBackend(self.rec)
+		self.m = self.TestMap(self.gb, magic=False)
+
+	def test_setall_rmw(self):
+		rec = self.rec
+		self.m._setall({'reg1': {'field1': 3}, 'reg2': {'flag2': 'yes', 'flag3': None}})
+		self.assertEqual(rec.pop(), (rec.GET, 0, 32, 0xb000))
+		self.assertEqual(rec.pop(), (rec.SET, 0, 32, 0xf003))
+		self.assertTrue(rec.empty())
+		self.m.reg1._update(field1=1, field2=2)
+		self.assertEqual(rec.pop(), (rec.GET, 0, 32, 0xf003))
+		self.assertEqual(rec.pop(), (rec.SET, 0, 32, 0xf021))
+		self.assertTrue(rec.empty())
+
+	def test_setall_full(self):
+		rec = self.rec
+		self.gb.granularity = 4
+		self.m.reg2._update(flag0=1, flag1=0, flag2='no', flag3=1)
+		self.assertEqual(rec.pop(), (rec.SET, 12, 4, 9))
+		self.assertTrue(rec.empty())
+		self.m._update()
+		self.assertTrue(rec.empty())
+
+	def test_setall_errors(self):
+		with self.assertRaises(ValueError):
+			self.m.reg1._update(field1=16)
+		with self.assertRaises(TypeError):
+			self.m.reg32._update(status0=1)
+		with self.assertRaises(AttributeError):
+			self.m.reg1._update(field3=1)
+		self.assertTrue(self.rec.empty())
+
+class WriteBackCacheTest(BaseTestCase):
+	def setUp(self):
+		super(WriteBackCacheTest, self).setUp()
+		self.rec = BackendRecorder(IntBackend())
+		self.wb = WriteBackCache(self.rec, max_granules=4)
+		self.m = self.TestMap(self.wb, magic=True)
+
+	def test_coalesce(self):
+		rec = self.rec
+		self.m.reg1.field1 = 1
+		self.m.reg1.field2 = 2
+		self.m.reg2.flag2 = 'yes'
+		self.assertEqual(self.m.reg1.field2, 2)
+		self.assertTrue(rec.empty())
+		self.wb.flush()
+		self.assertEqual(rec.pop(), (rec.GET, 0, 32, 0))
+		self.assertEqual(rec.pop(), (rec.SET, 0, 32, 0x4021))
+		self.assertTrue(rec.empty())
+		self.m.reg1.field1 = 3
+		self.wb.flush()
+		self.assertEqual(rec.pop(), (rec.SET, 0, 32, 0x4023))
+		self.assertTrue(rec.empty())
+		self.wb.flush()
+		self.assertTrue(rec.empty())
+
+	def test_full_granules(self):
+		rec = self.rec
+		self.wb.set_bits(32, 32, 0x11111111)
+		self.wb.set_bits(64, 64, 0x3333333322222222)
+		self.wb.set_bits(160, 32, 0x55555555)
+		self.assertEqual(self.wb.get_bits(48, 32), 0x22221111)
+		self.assertTrue(rec.empty())
+		self.wb.flush()
+		self.assertEqual(rec.pop(), (rec.SET, 32, 96, 0x333333332222222211111111))
+		self.assertEqual(rec.pop(), (rec.SET, 160, 32, 0x55555555))
+		self.assertTrue(rec.empty())
+
+	def test_eviction(self):
+		rec = self.rec
+		for k in xrange(4):
+			self.wb.set_bits(k * 32, 32, k)
+		self.assertTrue(rec.empty())
+		self.wb.get_bits(0, 32)
+		self.wb.set_bits(4 * 32, 32, 4)
+		# granule 1 was the least recently used one
+		self.assertEqual(rec.pop(), (rec.SET, 32, 32, 1))
+		self.assertTrue(rec.empty())
+		self.assertEqual(len(self.wb.granules), 4)
+
+	def test_volatile(self):
+		rec = self.rec
+		self.wb.mark_volatile(self.m.reg32._reg)
+		self.assertEqual(self.m.reg1.field1, 0)
+		self.assertEqual(rec.pop(), (rec.GET, 0, 32, 0))
+		self.m.reg32.flag = 1
+		self.assertEqual(rec.pop(), (rec.SET, 8 * 0x32 + 14, 1, 1))
+		self.assertEqual(self.m.reg32.status0, 0)
+		self.assertEqual(self.m.reg32.status0, 0)
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 8 * 0x32, 1))
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 8 * 0x32, 1))
+		self.assertEqual(self.m.reg1.field1, 0)
+		self.assertTrue(rec.empty())
+
+	def test_volatile_policy(self):
+		rec = self.rec
+		self.wb.apply_policies(Register("test", defs = [
+			AtByte(0x32),
+			Register("reg32", 16, cache=Register.CACHE_VOLATILE),
+		])())
+		self.assertEqual(self.wb.volatile.lookup(8 * 0x32, 16), [True])
+		self.assertEqual(self.wb.volatile.lookup(0, 8 * 0x32), [])
+		self.assertEqual(self.m.reg32.status0, 0)
+		self.assertEqual(self.m.reg32.status0, 0)
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 8 * 0x32, 1))
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 8 * 0x32, 1))
+		self.assertTrue(rec.empty())
+
+	def test_volatile_writeback(self):
+		ib = IntBackend()
+		wb = WriteBackCache(ib)
+		wb.set_volatile(16, 16)
+		wb.set_bits(0, 16, 0xaaaa)
+		wb.set_bits(16, 16, 0x1234)
+		wb.set_bits(0, 16, 0xbbbb)
+		self.assertEqual(ib.value, 0x1234aaaa)
+		wb.flush()
+		self.assertEqual(ib.value, 0x1234bbbb)
+		ib.value = 0x5678bbbb
+		wb.set_bits(0, 16, 0xcccc)
+		wb.flush()
+		self.assertEqual(ib.value, 0x5678cccc)
+		self.assertEqual(wb.get_bits(16, 16), 0x5678)
+		self.assertEqual(wb.granules[0][0] >> 16, 0x5678)
+
+	def test_rangemap(self):
+		rm = RangeMap()
+		rm.add(10, 5, 'a')
+		rm.add(20, 5, 'b')
+		self.assertEqual(rm.lookup(0, 10), [])
+		self.assertEqual(rm.lookup(14, 1), ['a'])
+		self.assertEqual(rm.lookup(14, 7), ['a', 'b'])
+		self.assertEqual(rm.lookup(15, 5), [])
+		with self.assertRaises(ValueError):
+			rm.add(24, 10, 'c')
+
+class ReadCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.TestMap = Register("test", defs = [
+			Register("id", 32, cache=Register.CACHE_CONSTANT),
+			Register("temp", 16, cache=0.5),
+			RegRO("status", 8, cache=Register.CACHE_VOLATILE),
+			Register("ctrl", 8),
+		])
+		self.now = 100.0
+		self.rec = BackendRecorder(IntBackend(0x12345678))
+		self.be = ReadCacheBackend(self.rec, clock=lambda: self.now)
+		self.m = self.TestMap(self.be)
+		self.be.apply_policies(self.m)
+
+	def test_policies(self):
+		self.assertEqual(list(self.m._cache_policies()), [
+			(0, 32, Register.CACHE_CONSTANT),
+			(32, 16, 0.5),
+			(48, 8, Register.CACHE_VOLATILE),
+		])
+		self.assertEqual(self.be.lifetime(0, 32), float('inf'))
+		self.assertEqual(self.be.lifetime(0, 48), 0.5)
+		self.assertEqual(self.be.lifetime(32, 24), 0)
+		self.assertEqual(self.be.lifetime(56, 8), 0)
+
+	def test_cached_reads(self):
+		rec = self.rec
+		m = self.m
+		for k in xrange(3):
+			self.assertEqual(m.id._get(), 0x12345678)
+			self.assertEqual(m.temp._get(), 0)
+			self.assertEqual(m.status._get(), 0)
+			self.assertEqual(m.ctrl._get(), 0)
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 0, 32))
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 32, 16))
+		for k in xrange(3):
+			self.assertEqual(rec.pop_nodata(), (rec.GET, 48, 8))
+			self.assertEqual(rec.pop_nodata(), (rec.GET, 56, 8))
+		self.assertTrue(rec.empty())
+		self.now += 1
+		m.id._get()
+		m.temp._get()
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 32, 16))
+		self.assertTrue(rec.empty())
+		m.temp._set(5)
+		self.assertEqual(rec.pop_nodata(), (rec.SET, 32, 16))
+		self.assertEqual(m.temp._get(), 5)
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 32, 16))
+		self.assertTrue(rec.empty())
+
+	def test_invalidate(self):
+		be = ReadCacheBackend(IntBackend(), default=Register.CACHE_CONSTANT)
+		for start, length in ((0, 32), (8, 8), (16, 4), (40, 8), (64, 64)):
+			be.get_bits(start, length)
+		be.invalidate(12, 6)
+		self.assertEqual(sorted(be.cache), [(40, 8), (64, 64)])
+		self.assertEqual(be.keys, [(40, 8), (64, 64)])
+		be.invalidate(127, 10)
+		self.assertEqual(be.keys, [(40, 8)])
+		be.invalidate(48, 16)
+		self.assertEqual(be.keys, [(40, 8)])
+		be.invalidate()
+		self.assertEqual((be.cache, be.keys), ({}, []))
+
+class ShadowTest(BaseTestCase):
+	def test_shadow(self):
+		cmd1 = 1 << (8 * 0x32 + 4)
+		rec = BackendRecorder(IntBackend(cmd1))
+		sb = ShadowBackend(rec)
+		gb = GranularBackend(sb)
+		gb.granularity = 16
+		m = self.TestMap(gb, magic=True)
+		sb.attach(m._reg)
+		self.assertIsNone(m.reg32._reg._getall()['cmd1'])
+		rec.pop()
+		# the device reads back 1 for cmd1; don't write that back
+		m.reg32.flag = 1
+		self.assertEqual(rec.pop(), (rec.GET, 8 * 0x32, 16, 0x10))
+		self.assertEqual(rec.pop(), (rec.SET, 8 * 0x32, 16, 0x4000))
+		m.reg32.cmd1 = 1
+		m.reg32.flag = 0
+		self.assertEqual(rec.pop(), (rec.GET, 8 * 0x32, 16, 0x4000))
+		self.assertEqual(rec.pop(), (rec.SET, 8 * 0x32, 16, 0x4010))
+		self.assertEqual(rec.pop(), (rec.GET, 8 * 0x32, 16, 0x4010))
+		self.assertEqual(rec.pop(), (rec.SET, 8 * 0x32, 16, 0x10))
+		self.assertTrue(rec.empty())
+		self.assertEqual(m.reg32._reg._getall()['cmd1'], 1)
+		self.assertEqual(m.reg32._reg.cmd1._getall(), 1)
+		with self.assertRaises(TypeError):
+			m.reg32.cmd1
+		# only write-only bits: the device is not read
+		reads = len(rec.log)
+		self.assertEqual(sb.get_bits(8 * 0x32 + 4, 1), 1)
+		self.assertEqual(len(rec.log), reads)
+
+class ThreadingTest(unittest.TestCase):
+	def setUp(self):
+		self.TestMap = Register("test", defs = [
+			Register("counters", defs = [
+				Register("c%d" % k, 8) for k in xrange(4)
+			]),
+			Register("shared", 16),
+			Register("other", 16),
+		])
+		self.interval = sys.getcheckinterval()
+		sys.setcheckinterval(1)
+	def tearDown(self):
+		sys.setcheckinterval(self.interval)
+
+	def run_threads(self, count, func):
+		threads = [threading.Thread(target=func, args=(k,)) for k in xrange(count)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+	def test_stress(self):
+		# unlike IntBackend, separate words of memory can be written concurrently
+		fp = tempfile.TemporaryFile()
+		fp.write('\0' * 16)
+		fp.flush()
+		be = LockingBackend(CachingBackend(GranularBackend(MmapBackend(fp))))
+		m = self.TestMap(be)
+		rounds = 200
+		def worker(k):
+			mine = getattr(m.counters, "c%d" % k)
+			for n in xrange(rounds):
+				# disjoint fields, sharing a granule
+				mine._set((mine._get() + 1) & 0xff)
+				# the same field, from all threads
+				with rmw_access(m.shared) as shared:
+					shared._set(shared._get() + 1)
+				# a neighbour of shared, in its granule
+				m.other._set(n)
+		self.run_threads(4, worker)
+		self.assertEqual(m.counters._getall(), dict(("c%d" % k, rounds & 0xff) for k in xrange(4)))
+		self.assertEqual(m.shared._get(), 4 * rounds)
+		self.assertEqual(m.other._get(), rounds - 1)
+
+	def test_wide_granules(self):
+		# the wrapped backend rewrites whole 64-bit words
+		fp = tempfile.TemporaryFile()
+		fp.write('\0' * 16)
+		fp.flush()
+		gb = GranularBackend(MmapBackend(fp))
+		gb.granularity = 64
+		be = LockingBackend(gb)
+		self.assertEqual(be._locks(40, 8), be._locks(0, 8))
+		m = Register("test", defs = [Register("lo", 32), Register("hi", 32)])(be)
+		rounds = 2000
+		def worker(k):
+			half = m.hi if k else m.lo
+			for n in xrange(rounds):
+				with rmw_access(half) as reg:
+					reg._set(reg._get() + 1)
+		self.run_threads(2, worker)
+		self.assertEqual(m._getall(), {'lo': rounds, 'hi': rounds})
+		be = LockingBackend(CachingBackend(gb), stripes=2)
+		self.assertEqual(be.granularity, 64)
+		self.assertEqual(be._locks(0, 1024), be.locks)
+		self.assertEqual(be._locks(64, 8), be._locks(192, 8))
+
+	def test_per_thread_cache(self):
+		be = CachingBackend(IntBackend())
+		m = self.TestMap(be)
+		entered = threading.Event()
+		done = threading.Event()
+		def worker(k):
+			with rmw_access(m.shared) as shared:
+				shared._set(1)
+				entered.set()
+				done.wait()
+		thread = threading.Thread(target=worker, args=(0,))
+		thread.start()
+		entered.wait()
+		# not inside the other thread's update
+		self.assertEqual(len(be.cache), 1)
+		self.assertEqual(m.shared._get(), 0)
+		done.set()
+		thread.join()
+		self.assertEqual(m.shared._get(), 1)
+
 class ContextManagerTest(BaseTestCase):
 	def setUp(self):
 		super(ContextManagerTest, self).setUp()
@@ -272,6 +840,45 @@ class ContextManagerTest(BaseTestCase):
 		m.reg1.field2 = 1
 		self.assertEqual(m.reg1.field2, 1)
 
+	def test_nested_cache(self):
+		rec = self.rec
+		m = self.TestMap(self.cb, magic=True)
+		with rmw_access(m) as outer:
+			self.assertEqual(rec.pop(), (rec.GET, 0, 416, 0))
+			with m.reg1 as reg:
+				reg.field1 = 1
+			with read_access(m.reg2) as reg:
+				self.assertEqual(reg.flag2, 0)
+			with write_access(m.reg2) as reg:
+				reg.flag0 = 1
+				reg.flag1 = 0
+				reg.flag2 = 'yes'
+				reg.flag3 = 0
+			self.assertEqual(outer.reg1.field1, 1)
+			self.assertTrue(rec.empty())
+		self.assertEqual(rec.pop(), (rec.SET, 0, 416, 0x5001))
+		self.assertTrue(rec.empty())
+
+	def test_nested_cache_extend(self):
+		rec = self.rec
+		m = self.TestMap(self.cb, magic=False)
+		with rmw_access(m.reg2) as outer:
+			self.assertEqual(rec.pop(), (rec.GET, 0, 32, 0))
+			with self.assertRaises(KeyError):
+				with rmw_access(m.reg1) as reg:
+					# outside the outer region: extend it
+					self.assertEqual(rec.pop(), (rec.GET, 0, 32, 0))
+					reg.field1(3)
+					raise KeyError
+			self.assertEqual(m.reg1.field1(), 0)
+			with rmw_access(m.reg1) as reg:
+				reg.field2(3)
+			outer.flag3(1)
+			self.assertTrue(rec.empty())
+		self.assertEqual(rec.pop(), (rec.GET, 0, 32, 0))
+		self.assertEqual(rec.pop(), (rec.SET, 0, 32, 0x8030))
+		self.assertTrue(rec.empty())
+
 	def test_readonly_write(self):
 		rec = self.rec
 		m = self.TestMap(self.cb, magic=True)
@@ -313,5 +920,42 @@ class ContextManagerTest(BaseTestCase):
 		self.assertEqual(rec.pop(), (rec.SET, 8 * 0x32, 16, 0x10))
 		self.assertTrue(rec.empty())
 
+class SnapshotTest(BaseTestCase):
+	def test_diff(self):
+		rec = BackendRecorder(IntBackend(0x1234))
+		m = self.TestMap(rec)
+		before = m._snapshot()
+		self.assertEqual(rec.pop_nodata(), (rec.GET, 0, m._bit_length))
+		self.assertEqual(before.decode(), m._getall())
+		rec.backend.value ^= 0x8040 | (1 << (8 * 0x32 + 4)) | (1 << (8 * 0x32 + 14))
+		after = m._snapshot()
+		self.assertNotEqual(before, after)
+		changes = after.diff(before)
+		self.assertEqual([c[0] for c in changes], ['test.reg1.field2', 'test.reg2.flag3', 'test.reg32.flag'])
+		self.assertEqual(changes[0][1:], (0x23, 0x27))
+		self.assertEqual(changes[1][1:], (0, 1))
+		self.assertEqual(after.diff(after), [])
+		with self.assertRaises(ValueError):
+			after.diff(m.reg1._snapshot())
+
+	def test_diff_enum(self):
+		be = IntBackend()
+		m = self.TestMap(be)
+		before = m.reg2._snapshot()
+		be.value = 1 << 14
+		(name, old, new), = m.reg2._snapshot().diff(before)
+		self.assertEqual((name, str(old), str(new)), ('test.reg2.flag2', 'no', 'yes'))
+
+	def test_large(self):
+		TestMap = Register("big", defs = [
+			RegArray("r", 1 << 18, Register("elem", defs = [Register("a", 12), Register("b", 20)])),
+		])
+		m = TestMap(IntBackend((1 << (32 << 18)) - 1), lazy=True)
+		before = m._snapshot()
+		m._backend.value ^= (1 << 36) | (1 << ((32 << 18) - 1))
+		changes = m._snapshot().diff(before)
+		self.assertEqual([c[0] for c in changes], ['big.r.elem[1].a', 'big.r.elem[262143].b'])
+		self.assertEqual(changes[1][1:], (0xfffff, 0x7ffff))
+
 if __name__ == "__main__":
 	unittest.main()
@@ -2,6 +2,14 @@
 
 from regmap.utest import *
 from regmap.mmap_be import *
+from regmap.pipeline import *
+from regmap.remote import *
+from regmap.poll import *
+from regmap.trace import *
+from regmap.bench import BenchTest
+from regmap.metrics import *
+from regmap.loader import *
+from regmap.codegen import *
 import unittest
 
 if __name__ == "__main__":